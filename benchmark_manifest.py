@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Benchmark manifest queries against the JSON manifest and its shards.
+
+The baseline is what consumers of MANIFEST.json do: load the whole JSON
+file and build sets of the paths of each type, then use those sets for
+membership, type and prefix queries. It is compared with answering the
+same questions from the sharded manifest written by manifest_shards.py,
+which is created first if it is missing or out of date. Loading through
+tools.manifest instead of plain JSON is slower still, so the baseline
+understates the gain.
+
+By default the MANIFEST.json of this checkout is used, after bringing it
+up to date. Once loaded, an in-memory set answers a single membership
+test, or lists every path of a type, faster than the shards do; the
+shards win on load and prefix queries, and so on the total for the few
+directories a typical change touches.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import manifest_shards
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_types = ["testharness", "reftest", "wdspec"]
+
+
+def generate_manifest(path, count, seed):
+    """Write a synthetic manifest with count paths spread over a realistic
+    number of directories."""
+    rng = random.Random(seed)
+    top_dirs = ["dir%i" % i for i in range(150)]
+    items = {item_type: {} for item_type in test_types + ["support"]}
+    for i in range(count):
+        rel_path = "%s/sub%i/file%i.html" % (rng.choice(top_dirs), rng.randint(0, 20), i)
+        item_type = rng.choice(["testharness", "testharness", "support", "reftest"])
+        items[item_type][rel_path] = [["/" + rel_path, {}]]
+    with open(path, "wb") as f:
+        json.dump({"items": items, "paths": {}, "url_base": "/", "version": 4}, f)
+
+
+class Timer(object):
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args, **kwargs):
+        self.results.append((self.name, time.time() - self.start))
+
+
+def benchmark_json(manifest_path, queries, prefix):
+    results = []
+    with Timer("load", results):
+        with open(manifest_path, "rb") as f:
+            data = json.load(f)
+        support_files = {path for path in data["items"].get("support", {})}
+        test_files = {path for item_type in test_types
+                      for path in data["items"].get(item_type, {})}
+    with Timer("membership", results):
+        for path in queries:
+            path in support_files or path in test_files
+    with Timer("type", results):
+        type_count = sum(1 for _ in test_files)
+    with Timer("prefix", results):
+        prefix_count = sum(1 for path in test_files if path.startswith(prefix))
+    return results, type_count, prefix_count
+
+
+def benchmark_shards(manifest_path, queries, prefix):
+    results = []
+    with Timer("load", results):
+        sharded = manifest_shards.ShardedManifest.load(manifest_path)
+        support_files = manifest_shards.PathSet(sharded, ["support"])
+        test_files = manifest_shards.PathSet(sharded, test_types)
+    with Timer("membership", results):
+        for path in queries:
+            path in support_files or path in test_files
+    with Timer("type", results):
+        type_count = sum(1 for _ in sharded.iterpaths(*test_types))
+    with Timer("prefix", results):
+        prefix_count = sum(1 for _ in sharded.iterprefix(prefix, *test_types))
+    sharded.close()
+    return results, type_count, prefix_count
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--manifest", action="store",
+                        default=os.path.join(here, "MANIFEST.json"),
+                        help="Path to the manifest to benchmark, which is brought up to "
+                        "date first; defaults to the manifest of this checkout")
+    parser.add_argument("--synthetic", action="store", type=int,
+                        help="Benchmark a generated manifest with this many paths instead")
+    parser.add_argument("--queries", action="store", type=int, default=1000,
+                        help="Number of membership queries, for paths in a few directories")
+    parser.add_argument("--prefix", action="store",
+                        help="Directory prefix to query; defaults to a random directory")
+    parser.add_argument("--seed", action="store", type=int, default=0,
+                        help="Seed for the generated manifest and queries")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    rng = random.Random(args.seed)
+    tmp_dir = None
+    manifest_path = args.manifest
+    try:
+        if args.synthetic:
+            tmp_dir = tempfile.mkdtemp()
+            manifest_path = os.path.join(tmp_dir, "MANIFEST.json")
+            generate_manifest(manifest_path, args.synthetic, args.seed)
+        else:
+            import manifest_build
+            tests_root = os.path.dirname(os.path.abspath(manifest_path))
+            start = time.time()
+            if manifest_build.update_from_git(tests_root, manifest_path) is None:
+                manifest_build.build(tests_root, manifest_path)
+                manifest_build.record_rev(tests_root, manifest_path)
+            print("Updated manifest in %.2fs" % (time.time() - start))
+        if manifest_shards.ShardedManifest.load(manifest_path) is None:
+            start = time.time()
+            manifest_shards.write(manifest_path)
+            print("Wrote shards in %.2fs" % (time.time() - start))
+
+        with open(manifest_path, "rb") as f:
+            all_paths = sorted(path for paths in json.load(f)["items"].itervalues()
+                               for path in paths)
+        # Like a typical PR, the queries only touch a few directories
+        dirs = rng.sample(sorted({manifest_shards.top_dir(path) for path in all_paths}), 3)
+        candidates = [path for path in all_paths if manifest_shards.top_dir(path) in dirs]
+        queries = [rng.choice(candidates).replace("/", os.path.sep)
+                   for _ in range(args.queries)]
+        prefix = args.prefix or rng.choice(dirs) + "/"
+
+        json_results, json_types, json_prefix = benchmark_json(manifest_path, queries, prefix)
+        shard_results, shard_types, shard_prefix = benchmark_shards(manifest_path, queries, prefix)
+        assert (json_types, json_prefix) == (shard_types, shard_prefix)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    print("%i paths, %i tests, %i tests under %s" %
+          (len(all_paths), json_types, json_prefix, prefix))
+    print("%-12s %10s %10s %8s" % ("Query", "JSON", "Shards", "Speedup"))
+    json_results.append(("total", sum(elapsed for _, elapsed in json_results)))
+    shard_results.append(("total", sum(elapsed for _, elapsed in shard_results)))
+    for (name, json_time), (_, shard_time) in zip(json_results, shard_results):
+        print("%-12s %9.4fs %9.4fs %7.1fx" %
+              (name, json_time, shard_time, json_time / shard_time if shard_time else 0))
+
+
+if __name__ == "__main__":
+    main()
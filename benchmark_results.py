@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Benchmark the result processing in check_stability.py.
+
+Synthetic raw logs are generated for a configurable number of tests,
+subtests and iterations, and then aggregated, written out as a results
+file and rendered as Markdown, reporting the throughput and peak memory
+use of each stage. Nothing is installed and no browser is run.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import check_stability
+
+from mozlog import reader
+from mozlog.formatters import JSONFormatter
+from mozlog.handlers import StreamHandler
+
+
+def generate_logs(dest, tests, subtests, iterations, logs, flake_rate, seed,
+                  log_suffix=".log"):
+    """Write logs raw logs into dest, which together contain iterations
+    runs of each test, and return their paths and the number of messages
+    written.
+
+    The messages go through mozlog's StreamHandler into files opened with
+    check_stability.create_log, as wptrunner's raw logs do, so a
+    log_suffix of .log.gz or .log.bz2 exercises the compressed logs."""
+    rng = random.Random(seed)
+    paths = [os.path.join(dest, "raw-%i%s" % (i, log_suffix)) for i in range(logs)]
+    files = [check_stability.create_log(path) for path in paths]
+    handlers = [StreamHandler(f, JSONFormatter()) for f in files]
+    messages = 0
+    now = 0
+    try:
+        for iteration in range(iterations):
+            log = handlers[iteration % logs]
+            log({"action": "suite_start", "time": now, "tests": []})
+            for test_index in range(tests):
+                test = "/benchmark/test-%i.html" % test_index
+                log({"action": "test_start", "test": test, "time": now})
+                for subtest_index in range(subtests):
+                    now += rng.randint(1, 5)
+                    status = "FAIL" if rng.random() < flake_rate else "PASS"
+                    log({"action": "test_status",
+                         "test": test,
+                         "subtest": "Subtest %i" % subtest_index,
+                         "status": status,
+                         "time": now})
+                now += rng.randint(1, 50)
+                log({"action": "test_end", "test": test, "status": "OK", "time": now})
+                messages += subtests + 2
+            log({"action": "suite_end", "time": now})
+            messages += 2
+    finally:
+        for f in files:
+            f.close()
+    return paths, messages
+
+
+def max_rss():
+    """Peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Stage(object):
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.results.append((self.name, time.time() - self.start, max_rss()))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tests", action="store", type=int, default=200,
+                        help="Number of tests")
+    parser.add_argument("--subtests", action="store", type=int, default=50,
+                        help="Number of subtests in each test")
+    parser.add_argument("--iterations", action="store", type=int, default=10,
+                        help="Number of times each test is run")
+    parser.add_argument("--logs", action="store", type=int, default=1,
+                        help="Number of logs to split the iterations between")
+    parser.add_argument("--flake-rate", action="store", type=float, default=0.001,
+                        help="Probability of each subtest result being a FAIL")
+    parser.add_argument("--seed", action="store", type=int, default=0,
+                        help="Seed for the random statuses and timings")
+    parser.add_argument("--log-compression", action="store", default="none",
+                        choices=["none", "gzip", "bz2"],
+                        help="Compression of the generated raw logs")
+    parser.add_argument("--keep", action="store",
+                        help="Directory to keep the generated logs and results in")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+
+    # Keep the reports out of the output; they are still formatted
+    check_stability.logger.handlers = [logging.NullHandler()]
+    check_stability.reader = reader
+    check_stability.setup_log_handler()
+
+    dest = args.keep or tempfile.mkdtemp()
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    results_path = os.path.join(dest, "results.jsonl")
+    log_suffix = {"none": ".log", "gzip": ".log.gz", "bz2": ".log.bz2"}[args.log_compression]
+    stages = []
+    try:
+        with Stage("generate", stages):
+            log_paths, messages = generate_logs(dest, args.tests, args.subtests,
+                                                args.iterations, args.logs,
+                                                args.flake_rate, args.seed,
+                                                log_suffix)
+        log_size = sum(os.stat(path).st_size for path in log_paths)
+
+        with Stage("process", stages):
+            handler = check_stability.process_results(log_paths, args.iterations,
+                                                      results_file=results_path)
+        with Stage("inconsistent", stages):
+            if handler.inconsistent:
+                check_stability.write_inconsistent(handler.inconsistent, handler.known_flaky)
+        with Stage("markdown", stages):
+            check_stability.write_results(check_stability.iter_results(results_path), None)
+    finally:
+        if not args.keep:
+            shutil.rmtree(dest)
+
+    print("%i messages, %.1f MB of logs, %i unstable subtests" %
+          (messages, log_size / 1024.0 ** 2, len(handler.inconsistent)))
+    print("%-14s %10s %16s %14s" % ("Stage", "Time", "Messages/s", "Peak RSS"))
+    for name, elapsed, rss in stages:
+        print("%-14s %9.2fs %16.0f %11.1f MB" %
+              (name, elapsed, messages / elapsed if elapsed else 0, rss))
+
+
+if __name__ == "__main__":
+    main()
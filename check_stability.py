@@ -1,23 +1,41 @@
 from __future__ import print_function
 
 import argparse
+import bz2
+import gzip
+import hashlib
+import heapq
+import inspect
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import posixpath
+import Queue
 import re
+import shutil
+import sqlite3
 import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import traceback
 import zipfile
-from cStringIO import StringIO
-from collections import defaultdict
+import zlib
+from array import array
+from collections import defaultdict, namedtuple
 from ConfigParser import RawConfigParser
 from io import BytesIO
-from urlparse import urljoin
-from tools.manifest import manifest
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlsplit
 
+import manifest_build
+import manifest_shards
 import requests
 
 BaseHandler = None
@@ -29,8 +47,10 @@ TbplFormatter = None
 reader = None
 wptcommandline = None
 wptrunner = None
+wpt_manifest = None
 wpt_root = None
 wptrunner_root = None
+log_suffix = ".log"
 
 logger = logging.getLogger(os.path.splitext(__file__)[0])
 
@@ -92,15 +112,55 @@ class TravisFold(object):
         print("travis_fold:end:%s" % self.name, file=sys.stderr)
 
 
+class CachedResponse(object):
+    """Response to a GET that was revalidated, built from the cached body
+    and links of an earlier response."""
+    def __init__(self, data, links):
+        self.data = data
+        self.links = links
+
+    def json(self):
+        return self.data
+
+
 class GitHub(object):
-    def __init__(self, org, repo, token, product):
+    """Client for the parts of the GitHub API used to post results.
+
+    All requests share one keep-alive session. The bodies of GET responses
+    carrying an ETag are stored in a file kept between runs, and revalidated
+    with If-None-Match the next time they are fetched, so that re-fetching
+    an unchanged resource costs a 304 response, which doesn't count against
+    the rate limit. Only the responses used by the latest run are kept.
+    Paginated listings are followed lazily through their Link headers.
+
+    :param api_root: Root URL of the API, which can point at a local
+                     stand-in server for testing.
+    :param cache_path: Path to the JSON file holding the cached responses,
+                       or None to only cache them for this run.
+    """
+    def __init__(self, org, repo, token, product, api_root="https://api.github.com/",
+                 cache_path=None):
         self.token = token
         self.headers = {"Accept": "application/vnd.github.v3+json"}
         self.auth = (self.token, "x-oauth-basic")
         self.org = org
         self.repo = repo
-        self.base_url = "https://api.github.com/repos/%s/%s/" % (org, repo)
+        self.api_root = api_root
+        self.base_url = urljoin(api_root, "repos/%s/%s/" % (org, repo))
         self.product = product
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.cache_path = cache_path
+        self._responses = {}
+        self._used = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    self._responses = json.load(f)
+            except ValueError:
+                logger.warning("Ignoring corrupt GitHub response cache %s" % cache_path)
+        self._user = None
+        self._comments = {}
 
     def _headers(self, headers):
         if headers is None:
@@ -113,11 +173,19 @@ class GitHub(object):
         logger.debug("POST %s" % url)
         if data is not None:
             data = json.dumps(data)
-        resp = requests.post(
+        resp = self.session.post(
             url,
             data=data,
-            headers=self._headers(headers),
-            auth=self.auth
+            headers=self._headers(headers)
+        )
+        resp.raise_for_status()
+        return resp
+
+    def delete(self, url, headers=None):
+        logger.debug("DELETE %s" % url)
+        resp = self.session.delete(
+            url,
+            headers=self._headers(headers)
         )
         resp.raise_for_status()
         return resp
@@ -126,84 +194,195 @@ class GitHub(object):
         logger.debug("PATCH %s" % url)
         if data is not None:
             data = json.dumps(data)
-        resp = requests.patch(
+        resp = self.session.patch(
             url,
             data=data,
-            headers=self._headers(headers),
-            auth=self.auth
+            headers=self._headers(headers)
         )
         resp.raise_for_status()
         return resp
 
     def get(self, url, headers=None):
         logger.debug("GET %s" % url)
-        resp = requests.get(
+        headers = self._headers(headers)
+        cached = self._responses.get(url)
+        if cached is not None:
+            headers["If-None-Match"] = cached["etag"]
+        resp = self.session.get(
             url,
-            headers=self._headers(headers),
-            auth=self.auth
+            headers=headers
         )
+        if resp.status_code == 304 and cached is not None:
+            logger.debug("%s not modified" % url)
+            self._save(url, cached)
+            return CachedResponse(cached["data"], cached["links"])
         resp.raise_for_status()
+        if "ETag" in resp.headers:
+            self._save(url, {"etag": resp.headers["ETag"],
+                             "data": resp.json(),
+                             "links": resp.links})
         return resp
 
-    def post_comment(self, issue_number, body):
-        user = self.get(urljoin(self.base_url, "/user")).json()
-        issue_comments_url = urljoin(self.base_url, "issues/%s/comments" % issue_number)
-        comments = self.get(issue_comments_url).json()
-        title_line = format_comment_title(self.product)
+    def _save(self, url, entry):
+        self._responses[url] = self._used[url] = entry
+        if self.cache_path is None:
+            return
+        dir_name = os.path.dirname(self.cache_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump(self._used, f)
+        os.rename(tmp_path, self.cache_path)
+
+    def iter_pages(self, url):
+        """Iterate over the items of a paginated listing, only fetching each
+        page once the previous one is exhausted."""
+        while url:
+            resp = self.get(url)
+            for item in resp.json():
+                yield item
+            url = resp.links.get("next", {}).get("url")
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = self.get(urljoin(self.api_root, "user")).json()
+        return self._user
+
+    def find_comments(self, issue_number):
+        """Return a dict mapping the first line of each comment on an issue
+        posted by the authenticated user to the comment. The comments are
+        only listed once per issue."""
+        if issue_number not in self._comments:
+            issue_comments_url = urljoin(self.base_url,
+                                         "issues/%s/comments?per_page=100" % issue_number)
+            comments = {}
+            for comment in self.iter_pages(issue_comments_url):
+                if comment["user"]["login"] == self.user["login"]:
+                    comments.setdefault(comment["body"].split("\n", 1)[0], comment)
+            self._comments[issue_number] = comments
+        return self._comments[issue_number]
+
+    def find_comment(self, issue_number, title_line):
+        """Return the first comment on an issue posted by the authenticated
+        user whose first line is title_line, or None."""
+        return self.find_comments(issue_number).get(title_line)
+
+    def post_comment(self, issue_number, body, title_line=None):
+        """Create or update the comment whose first line is title_line,
+        which defaults to the title for the product. A comment whose body
+        is already the same is left alone."""
+        if title_line is None:
+            title_line = format_comment_title(self.product)
         data = {"body": body}
-        for comment in comments:
-            if (comment["user"]["login"] == user["login"] and
-                comment["body"].startswith(title_line)):
-                comment_url = urljoin(self.base_url, "issues/comments/%s" % comment["id"])
-                self.patch(comment_url, data)
-                break
+        comment = self.find_comment(issue_number, title_line)
+        if comment is not None:
+            if comment["body"] == body:
+                logger.debug("Comment %s is unchanged" % comment["id"])
+                return
+            comment_url = urljoin(self.base_url, "issues/comments/%s" % comment["id"])
+            resp = self.patch(comment_url, data)
         else:
-            self.post(issue_comments_url, data)
+            issue_comments_url = urljoin(self.base_url, "issues/%s/comments" % issue_number)
+            resp = self.post(issue_comments_url, data)
+        self._comments[issue_number][title_line] = resp.json()
+
+    def delete_comment(self, issue_number, title_line):
+        comment = self.find_comments(issue_number).pop(title_line)
+        self.delete(urljoin(self.base_url, "issues/comments/%s" % comment["id"]))
 
 
 class GitHubCommentHandler(logging.Handler):
-    def __init__(self, github, pull_number):
+    """Logging handler that posts the log as comments on a PR.
+
+    Records are collected into pages of at most page_size characters, and
+    each page is sent as soon as it is full, so only one page is held in
+    memory. The first page starts with the title for the product and later
+    pages with "<title> (part n)". Pages are matched to the comments from a
+    previous run by that exact first line, and only written if their
+    content changed; comments for pages that are no longer needed are
+    deleted.
+
+    :param page_size: Maximum length of a comment, which GitHub limits to
+                      65536 characters
+    """
+    def __init__(self, github, pull_number, page_size=60000):
         logging.Handler.__init__(self)
         self.github = github
         self.pull_number = pull_number
-        self.log_data = []
+        self.page_size = page_size
+        self.title = format_comment_title(github.product)
+        self.page_number = 1
+        self.page = []
+        self.page_len = 0
+
+    def page_title(self, page_number):
+        if page_number == 1:
+            return self.title
+        return "%s (part %i)" % (self.title, page_number)
 
     def emit(self, record):
         try:
             msg = self.format(record)
-            self.log_data.append(msg)
+            if msg == self.title:
+                return
+            limit = self.page_size - len(self.page_title(self.page_number + 1)) - 1
+            msg = msg[:limit]
+            if self.page and self.page_len + len(msg) + 1 > limit:
+                self.send_page()
+            self.page.append(msg)
+            self.page_len += len(msg) + 1
         except Exception:
             self.handleError(record)
 
+    def send_page(self):
+        title_line = self.page_title(self.page_number)
+        self.github.post_comment(self.pull_number,
+                                 "\n".join([title_line] + self.page),
+                                 title_line)
+        self.page_number += 1
+        self.page = []
+        self.page_len = 0
+
     def send(self):
-        self.github.post_comment(self.pull_number, "\n".join(self.log_data))
-        self.log_data = []
+        self.send_page()
+        part_re = re.compile(r"%s \(part (\d+)\)$" % re.escape(self.title))
+        for title_line in self.github.find_comments(self.pull_number).keys():
+            m = part_re.match(title_line)
+            if m and int(m.group(1)) >= self.page_number:
+                self.github.delete_comment(self.pull_number, title_line)
 
 
 class Browser(object):
     product = None
     binary = None
+    requirements = None
 
-    def __init__(self, github_token):
+    def __init__(self, github_token, cache):
         self.github_token = github_token
+        self.cache = cache
+
+    def install_requirements(self):
+        """Install the Python packages wptrunner needs for this browser. This
+        depends on wptrunner having been cloned."""
+        call("pip", "install", "-r", os.path.join(wptrunner_root, self.requirements))
 
 
 class Firefox(Browser):
     product = "firefox"
     binary = "%s/firefox/firefox"
     platform_ini = "%s/firefox/platform.ini"
+    requirements = "requirements_firefox.txt"
 
     def install(self):
-        call("pip", "install", "-r", os.path.join(wptrunner_root, "requirements_firefox.txt"))
-        resp = get("https://archive.mozilla.org/pub/firefox/nightly/latest-mozilla-central/firefox-53.0a1.en-US.linux-x86_64.tar.bz2")
-        untar(resp.raw)
+        self.cache.extract("https://archive.mozilla.org/pub/firefox/nightly/latest-mozilla-central/firefox-53.0a1.en-US.linux-x86_64.tar.bz2",
+                           os.curdir)
 
         if not os.path.exists("profiles"):
             os.mkdir("profiles")
-        with open(os.path.join("profiles", "prefs_general.js"), "wb") as f:
-            resp = get("https://hg.mozilla.org/mozilla-central/raw-file/tip/testing/profiles/prefs_general.js")
-            f.write(resp.content)
-        call("pip", "install", "-r", os.path.join(wptrunner_root, "requirements_firefox.txt"))
+        self.cache.install("https://hg.mozilla.org/mozilla-central/raw-file/tip/testing/profiles/prefs_general.js",
+                           os.path.join("profiles", "prefs_general.js"))
 
     def _latest_geckodriver_version(self):
         # This is used rather than an API call to avoid rate limits
@@ -221,10 +400,16 @@ class Firefox(Browser):
         return "v%s.%s.%s" % tuple(str(item) for item in latest_release)
 
     def install_webdriver(self):
-        version = self._latest_geckodriver_version()
+        if self.cache.offline:
+            url = self.cache.last_url(r"/geckodriver-v[\d.]+-linux64\.tar\.gz$")
+            if url is None:
+                raise IOError("No geckodriver release in the artifact cache")
+            version = url.rsplit("/", 2)[-2]
+        else:
+            version = self._latest_geckodriver_version()
+            url = "https://github.com/mozilla/geckodriver/releases/download/%s/geckodriver-%s-linux64.tar.gz" % (version, version)
         logger.debug("Latest geckodriver release %s" % version)
-        url = "https://github.com/mozilla/geckodriver/releases/download/%s/geckodriver-%s-linux64.tar.gz" % (version, version)
-        untar(get(url).raw)
+        self.cache.extract(url, os.curdir, version=version)
 
     def version(self, root):
         """Retrieve the release version of the installed browser."""
@@ -249,17 +434,17 @@ class Firefox(Browser):
 class Chrome(Browser):
     product = "chrome"
     binary = "/usr/bin/google-chrome"
+    requirements = "requirements_chrome.txt"
 
     def install(self):
         # Installing the Google Chrome browser requires administrative
         # privileges, so that installation is handled by the invoking script.
-
-        call("pip", "install", "-r", os.path.join(wptrunner_root, "requirements_chrome.txt"))
+        pass
 
     def install_webdriver(self):
-        latest = get("http://chromedriver.storage.googleapis.com/LATEST_RELEASE").text.strip()
+        latest = self.cache.text("http://chromedriver.storage.googleapis.com/LATEST_RELEASE").strip()
         url = "http://chromedriver.storage.googleapis.com/%s/chromedriver_linux64.zip" % latest
-        unzip(get(url).raw)
+        self.cache.extract(url, os.curdir, version=latest)
         st = os.stat('chromedriver')
         os.chmod('chromedriver', st.st_mode | stat.S_IEXEC)
 
@@ -313,36 +498,404 @@ def get_git_cmd(repo_path):
     return git
 
 
+class ReadAhead(object):
+    """File-like wrapper that reads fileobj on a background thread.
+
+    Up to max_chunks chunks are buffered, so that the download can carry on
+    while the consumer is busy decompressing, without the whole response
+    being held in memory. Use it as a context manager, or call close(), so
+    that the thread stops if the consumer gives up before the end.
+    """
+    # Seconds between checks of whether the reader was closed while the
+    # buffer is full
+    put_timeout = 0.5
+
+    def __init__(self, fileobj, chunk_size=64 * 1024, max_chunks=32):
+        self.queue = Queue.Queue(max_chunks)
+        self.chunk = ""
+        self.pos = 0
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(fileobj, chunk_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.stopped.set()
+
+    def _put(self, item):
+        """Queue item, returning False if the reader was closed first."""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=self.put_timeout)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fill(self, fileobj, chunk_size):
+        try:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not self._put(chunk) or not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self.eof:
+            if self.pos >= len(self.chunk):
+                self.chunk = self.queue.get()
+                self.pos = 0
+                if isinstance(self.chunk, Exception):
+                    raise self.chunk
+                if not self.chunk:
+                    self.eof = True
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.pos + size)
+            parts.append(self.chunk[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return "".join(parts)
+
+
+class HashingTee(object):
+    """File-like wrapper that copies everything read from fileobj to out,
+    updating digest with it."""
+    def __init__(self, fileobj, out, digest):
+        self.fileobj = fileobj
+        self.out = out
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        self.out.write(data)
+        return data
+
+    def drain(self):
+        while self.read(64 * 1024):
+            pass
+
+
 def seekable(fileobj):
     try:
         fileobj.seek(fileobj.tell())
     except Exception:
-        return StringIO(fileobj.read())
+        # Spool to disk rather than buffering the whole stream in memory
+        rv = tempfile.TemporaryFile()
+        shutil.copyfileobj(fileobj, rv, 64 * 1024)
+        rv.seek(0)
+        return rv
     else:
         return fileobj
 
 
-def untar(fileobj):
+def untar(fileobj, dest="."):
     logger.debug("untar")
-    fileobj = seekable(fileobj)
-    with tarfile.open(fileobj=fileobj) as tar_data:
-        tar_data.extractall()
+    # Stream mode decompresses as data arrives and never seeks
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar_data:
+        tar_data.extractall(dest)
 
 
-def unzip(fileobj):
+def unzip(fileobj, dest="."):
     logger.debug("unzip")
     fileobj = seekable(fileobj)
     with zipfile.ZipFile(fileobj) as zip_data:
         for info in zip_data.infolist():
-            zip_data.extract(info)
+            zip_data.extract(info, dest)
             perm = info.external_attr >> 16 & 0x1FF
-            os.chmod(info.filename, perm)
+            os.chmod(os.path.join(dest, info.filename), perm)
+
+
+class ArtifactCache(object):
+    """Content-addressed cache for downloaded browser and webdriver artifacts.
+
+    Downloads are stored in blobs/, named by the SHA-256 of their contents,
+    and the index maps the URL of each download together with its version
+    (either given explicitly or taken from the ETag the server reports) to
+    a blob. Archives are extracted once into trees/ and installed by
+    hardlinking the extracted files, falling back to copying when the
+    destination is on another filesystem. Without keep_trees the extracted
+    files are removed again once installed, so only the downloads are kept.
+    The least recently used entries are evicted once the cache grows beyond
+    max_size.
+
+    In offline mode no requests are made and the most recently used entry
+    for a URL is returned, so a pre-seeded cache directory is sufficient to
+    install everything.
+
+    The cache can be used from several threads at once; access to the index
+    is serialised by a lock.
+
+    :param root: Directory holding the cache
+    :param max_size: Maximum total size of the cache in bytes
+    :param offline: Only use artifacts that are already in the cache
+    :param keep_trees: Keep the extracted contents of archives
+    """
+    def __init__(self, root, max_size=2 * 1024 ** 3, offline=False, keep_trees=True):
+        self.root = root
+        self.max_size = max_size
+        self.offline = offline
+        self.keep_trees = keep_trees
+        self.index_path = os.path.join(root, "index.json")
+        for name in ["blobs", "trees"]:
+            path = os.path.join(root, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.session = requests.Session()
+        self.lock = threading.RLock()
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "rb") as f:
+                    self.index = json.load(f)
+            except ValueError:
+                # Without the index nothing in the cache can be found or
+                # evicted, so start again from empty
+                logger.warning("Ignoring corrupt artifact cache index %s" % self.index_path)
+                for name in ["blobs", "trees"]:
+                    path = os.path.join(root, name)
+                    shutil.rmtree(path)
+                    os.makedirs(path)
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump(self.index, f, indent=1)
+        os.rename(tmp_path, self.index_path)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest)
+
+    def _tree_path(self, digest):
+        return os.path.join(self.root, "trees", digest)
+
+    def _lookup(self, url, version):
+        if version is not None:
+            key = hashlib.sha1("%s\0%s" % (url, version)).hexdigest()
+            with self.lock:
+                entry = self.index.get(key)
+            if entry is not None and os.path.exists(self._blob_path(entry["blob"])):
+                return key, entry
+            return key, None
+        # Without a version only the most recent entry for the URL is usable
+        with self.lock:
+            entries = [(item["used"], item_key, item)
+                       for item_key, item in self.index.iteritems()
+                       if item["url"] == url and
+                       os.path.exists(self._blob_path(item["blob"]))]
+        if not entries:
+            return None, None
+        _, key, entry = max(entries)
+        return key, entry
+
+    def last_url(self, pattern):
+        """Return the most recently used cached URL matching the regular
+        expression pattern, or None."""
+        with self.lock:
+            urls = [(entry["used"], entry["url"]) for entry in self.index.itervalues()
+                    if re.search(pattern, entry["url"])]
+        return max(urls)[1] if urls else None
+
+    def _resolve(self, url, version):
+        """Find the cache entry for url, returning a tuple of its key, the
+        entry itself or None if it isn't cached, and the version."""
+        if self.offline:
+            key, entry = self._lookup(url, version)
+            if entry is None:
+                raise IOError("%s is not in the artifact cache at %s" % (url, self.root))
+            return key, entry, version
+        if version is None:
+            resp = self.session.head(url, allow_redirects=True)
+            resp.raise_for_status()
+            version = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        key, entry = self._lookup(url, version) if version else (None, None)
+        if entry is not None:
+            logger.debug("Using cached %s" % url)
+        return key, entry, version
+
+    def _add(self, key, entry):
+        if key is None:
+            key = hashlib.sha1("%s\0%s" % (entry["url"], entry["blob"])).hexdigest()
+        with self.lock:
+            self.index[key] = entry
+
+    def _use(self, entry):
+        with self.lock:
+            entry["used"] = time.time()
+            self._evict(keep=entry["blob"])
+            self._save()
+
+    def fetch(self, url, version=None):
+        """Return the path to a cached copy of the resource at url, downloading
+        it first if necessary.
+
+        :param version: Identifier of the version of the resource, used in
+                        place of the ETag for resources whose URL embeds the
+                        version."""
+        key, entry, version = self._resolve(url, version)
+        if entry is None:
+            entry = self._download(url, version)
+            self._add(key, entry)
+        self._use(entry)
+        return self._blob_path(entry["blob"])
+
+    def _download(self, url, version, consume=None):
+        """Download url into the blob store.
+
+        :param consume: Optional callable that is passed a file-like object
+                        reading the response as it is downloaded, so that it
+                        can be processed while it is being written to the
+                        cache."""
+        resp = get(url)
+        resp.raw.decode_content = True
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "blobs"))
+        try:
+            with os.fdopen(fd, "wb") as f, ReadAhead(resp.raw) as read_ahead:
+                stream = HashingTee(read_ahead, f, digest)
+                if consume is not None:
+                    consume(stream)
+                stream.drain()
+            size = os.stat(tmp_path).st_size
+            os.rename(tmp_path, self._blob_path(digest.hexdigest()))
+        except:
+            os.unlink(tmp_path)
+            raise
+        return {"url": url,
+                "version": version,
+                "blob": digest.hexdigest(),
+                "size": size,
+                "tree_size": 0,
+                "used": time.time()}
+
+    def text(self, url, version=None):
+        """Return the contents of the resource at url."""
+        with open(self.fetch(url, version), "rb") as f:
+            return f.read()
+
+    def install(self, url, dest, version=None):
+        """Link the resource at url to the path dest."""
+        link_file(self.fetch(url, version), dest)
+
+    def extract(self, url, dest, version=None):
+        """Extract the tar or zip archive at url into the directory dest.
+
+        Tar archives that aren't cached yet are extracted while they are
+        being downloaded."""
+        key, entry, version = self._resolve(url, version)
+        tmp_path = None
+        if entry is None and not url.endswith(".zip"):
+            tmp_path = tempfile.mkdtemp(dir=os.path.join(self.root, "trees"))
+            try:
+                entry = self._download(url, version, lambda stream: untar(stream, tmp_path))
+            except:
+                shutil.rmtree(tmp_path)
+                raise
+            self._add(key, entry)
+        elif entry is None:
+            entry = self._download(url, version)
+            self._add(key, entry)
+
+        digest = entry["blob"]
+        tree_path = self._tree_path(digest)
+        if os.path.exists(tree_path):
+            if tmp_path is not None:
+                shutil.rmtree(tmp_path)
+        else:
+            if tmp_path is None:
+                tmp_path = tempfile.mkdtemp(dir=os.path.join(self.root, "trees"))
+                try:
+                    with open(self._blob_path(digest), "rb") as f:
+                        if f.read(4) == "PK\x03\x04":
+                            f.seek(0)
+                            unzip(f, tmp_path)
+                        else:
+                            f.seek(0)
+                            untar(f, tmp_path)
+                except:
+                    shutil.rmtree(tmp_path)
+                    raise
+            os.rename(tmp_path, tree_path)
+            if self.keep_trees:
+                tree_size = sum(os.lstat(os.path.join(dir_path, name)).st_size
+                                for dir_path, _, names in os.walk(tree_path)
+                                for name in names)
+                with self.lock:
+                    for item in self.index.itervalues():
+                        if item["blob"] == digest:
+                            item["tree_size"] = tree_size
+        self._use(entry)
+        link_tree(tree_path, dest)
+        if not self.keep_trees:
+            shutil.rmtree(tree_path)
+
+    def _evict(self, keep=None):
+        blobs = {}
+        for key, entry in self.index.iteritems():
+            used, size, keys = blobs.get(entry["blob"], (0, 0, []))
+            blobs[entry["blob"]] = (max(used, entry["used"]),
+                                    entry["size"] + entry["tree_size"],
+                                    keys + [key])
+        total = sum(size for _, size, _ in blobs.itervalues())
+        for used, digest in sorted((used, digest) for digest, (used, _, _) in blobs.iteritems()):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            _, size, keys = blobs[digest]
+            logger.debug("Evicting %s from artifact cache" % digest)
+            for key in keys:
+                del self.index[key]
+            if os.path.exists(self._blob_path(digest)):
+                os.unlink(self._blob_path(digest))
+            if os.path.exists(self._tree_path(digest)):
+                shutil.rmtree(self._tree_path(digest))
+            total -= size
+
+
+def link_file(src, dest):
+    """Hardlink src to dest, copying it if a link isn't possible."""
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def link_tree(src, dest):
+    """Recreate the directory tree at src under dest, hardlinking files."""
+    for dir_path, dir_names, file_names in os.walk(src):
+        rel_dir = os.path.relpath(dir_path, src)
+        dest_dir = os.path.normpath(os.path.join(dest, rel_dir))
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        for name in dir_names + file_names:
+            src_path = os.path.join(dir_path, name)
+            dest_path = os.path.join(dest_dir, name)
+            if os.path.islink(src_path):
+                if os.path.lexists(dest_path):
+                    os.unlink(dest_path)
+                os.symlink(os.readlink(src_path), dest_path)
+            elif name in file_names:
+                link_file(src_path, dest_path)
 
 
 def setup_github_logging(args):
     gh_handler = None
     if args.comment_pr:
-        github = GitHub(args.user, "web-platform-tests", args.gh_token, args.product)
+        github = GitHub(args.user, "web-platform-tests", args.gh_token, args.product,
+                        api_root=args.gh_api_root, cache_path=args.gh_cache or None)
         try:
             pr_number = int(args.comment_pr)
         except ValueError:
@@ -357,20 +910,6 @@ def setup_github_logging(args):
     return gh_handler
 
 
-class pwd(object):
-    def __init__(self, dir):
-        self.dir = dir
-        self.old_dir = None
-
-    def __enter__(self):
-        self.old_dir = os.path.abspath(os.curdir)
-        os.chdir(self.dir)
-
-    def __exit__(self, *args, **kwargs):
-        os.chdir(self.old_dir)
-        self.old_dir = None
-
-
 def fetch_wpt_master(user):
     git = get_git_cmd(wpt_root)
     git("fetch", "https://github.com/%s/web-platform-tests.git" % user, "master:master")
@@ -381,10 +920,117 @@ def get_sha1():
     return git("rev-parse", "HEAD").strip()
 
 
-def build_manifest():
-    with pwd(wpt_root):
-        # TODO: Call the manifest code directly
-        call("python", "manifest")
+def build_manifest(cache_path=None):
+    """Bring MANIFEST.json up to date, updating it in-process from the
+    changes since it was last built where possible.
+
+    :param cache_path: Path to a copy of the manifest kept between runs, used
+                       as the starting point when there is no local manifest.
+                       The classification cache is kept next to it, for when
+                       the manifest has to be rebuilt.
+    """
+    manifest_path = os.path.join(wpt_root, "MANIFEST.json")
+    if (cache_path and not os.path.exists(manifest_path) and
+        os.path.exists(cache_path) and manifest_build.read_rev(cache_path)):
+        shutil.copyfile(cache_path, manifest_path)
+        shutil.copyfile(cache_path + ".rev", manifest_path + ".rev")
+
+    start = time.time()
+    data = None
+    updated = manifest_build.update_from_git(wpt_root, manifest_path)
+    if updated is False:
+        logger.debug("Manifest is up to date")
+    elif updated is not None:
+        data = updated.to_json()
+        logger.debug("Updated manifest in %.2fs" % (time.time() - start))
+    else:
+        logger.debug("Rebuilding manifest")
+        classification_path = manifest_build.cache_path(manifest_path)
+        if (cache_path and not os.path.exists(classification_path) and
+            os.path.exists(manifest_build.cache_path(cache_path))):
+            shutil.copyfile(manifest_build.cache_path(cache_path), classification_path)
+        data = manifest_build.build(wpt_root, manifest_path)
+        manifest_build.record_rev(wpt_root, manifest_path)
+        logger.debug("Rebuilt manifest in %.2fs" % (time.time() - start))
+
+    # The shards are written from the manifest already in memory, and only
+    # when it changed or they are missing or stale
+    if data is not None or manifest_shards.ShardedManifest.load(manifest_path) is None:
+        manifest_shards.write(manifest_path, data=data)
+
+    if cache_path:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        shutil.copyfile(manifest_path, cache_path)
+        shutil.copyfile(manifest_path + ".rev", cache_path + ".rev")
+        if os.path.exists(manifest_build.cache_path(manifest_path)):
+            shutil.copyfile(manifest_build.cache_path(manifest_path),
+                            manifest_build.cache_path(cache_path))
+
+
+def run_steps(steps):
+    """Run a dependency graph of setup steps on a thread pool.
+
+    Each step is started as soon as all the steps it depends on have
+    finished, so independent steps overlap. If a step fails no further
+    steps are started, and the exception is re-raised once the steps that
+    are already running have finished.
+
+    :param steps: Dict mapping the name of each step to a tuple of the
+                  callable to run and the names of the steps it depends on
+    :returns: Dict mapping the name of each step to its duration in seconds
+    """
+    start = time.time()
+    pool = ThreadPool(len(steps))
+    finished = Queue.Queue()
+    pending = dict(steps)
+    durations = {}
+    running = 0
+    error = None
+
+    def run(name, func):
+        step_start = time.time()
+        try:
+            func()
+        except BaseException:
+            # Steps may call sys.exit(), for example through get_git_cmd. The
+            # SystemExit has to be handed to the main thread too, or it would
+            # wait for the step forever
+            finished.put((name, time.time() - step_start, sys.exc_info()))
+        else:
+            finished.put((name, time.time() - step_start, None))
+
+    try:
+        while pending or running:
+            if error is None:
+                ready = [name for name, (_, deps) in pending.iteritems()
+                         if all(dep in durations for dep in deps)]
+                if not ready and not running:
+                    raise ValueError("Unsatisfiable setup dependencies: %s" %
+                                     ", ".join(sorted(pending)))
+                for name in ready:
+                    logger.debug("Starting setup step %s" % name)
+                    pool.apply_async(run, (name, pending.pop(name)[0]))
+                    running += 1
+            elif not running:
+                break
+            name, duration, exc_info = finished.get()
+            running -= 1
+            logger.debug("Setup step %s %s after %.1fs" %
+                         (name, "failed" if exc_info else "finished", duration))
+            if exc_info is not None:
+                error = error or exc_info
+            else:
+                durations[name] = duration
+    finally:
+        pool.close()
+        pool.join()
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+    logger.debug("Setup took %.1fs; the steps took %.1fs in total" %
+                 (time.time() - start, sum(durations.itervalues())))
+    return durations
 
 
 def install_wptrunner():
@@ -407,25 +1053,417 @@ def get_files_changed():
             for item in files[:-1].split("\0")]
 
 
-def get_affected_testfiles(files_changed):
-    affected_testfiles = set()
-    nontests_changed = set(files_changed)
-    manifest_file = os.path.join(wpt_root, "MANIFEST.json")
+class RefScanner(object):
+    """Single-pass matcher for references to repository paths.
+
+    All the file extensions a reference may end with are compiled into one
+    regular expression, so that each file is scanned exactly once no matter
+    how many support files there are. Files are memory-mapped rather than
+    read into memory, and UTF-16 files are matched against an equivalently
+    encoded pattern rather than being decoded up front.
+
+    :param extensions: File extensions, including the leading dot, that are
+                       considered when looking for references.
+    """
+    path_chars = r"A-Za-z0-9_\-./~%+"
+    boms = {"\xfe\xff": "utf-16-be",
+            "\xff\xfe": "utf-16-le"}
+
+    def __init__(self, extensions):
+        extensions = sorted((ext[1:] for ext in extensions if ext),
+                            key=lambda x: (-len(x), x))
+        self.patterns = {}
+        if not extensions:
+            return
+        for encoding in [None] + self.boms.values():
+            self.patterns[encoding] = self._compile(extensions, encoding)
+
+    def _compile(self, extensions, encoding):
+        char = "[%s]" % self.path_chars
+        dot = r"\."
+        if encoding == "utf-16-le":
+            char, dot = "(?:%s\x00)" % char, dot + "\x00"
+        elif encoding == "utf-16-be":
+            char, dot = "(?:\x00%s)" % char, "\x00" + dot
+        alternatives = "|".join(re.escape(ext.encode(encoding) if encoding else ext)
+                                for ext in extensions)
+        # Without the lookbehind, finditer would retry from every offset of a
+        # long run of path characters, such as base64 data, making the scan
+        # quadratic in its length; with it each token is only tried once
+        return re.compile("(?<!%s)%s*%s(?:%s)(?!%s)" % (char, char, dot, alternatives, char))
+
+    def scan(self, full_path, rel_path):
+        """Return the set of repository paths that may be referenced from the
+        file at full_path, which lives at rel_path in the repository."""
+        if not self.patterns:
+            return set()
+        with open(full_path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                return set()
+        try:
+            encoding = self.boms.get(data[:2])
+            tokens = [match.group(0) for match in self.patterns[encoding].finditer(data)]
+        finally:
+            data.close()
+        if encoding:
+            tokens = [item.decode(encoding) for item in tokens]
+        return self.resolve(rel_path.replace(os.path.sep, "/"), tokens)
+
+    def resolve(self, rel_path, tokens):
+        rv = set()
+        test_dir = posixpath.dirname(rel_path)
+        for token in tokens:
+            candidates = []
+            if not token.startswith("/"):
+                candidates.append(posixpath.join(test_dir, token))
+            start = token.find("/")
+            while start != -1:
+                candidates.append(token[start + 1:])
+                start = token.find("/", start + 1)
+            for candidate in candidates:
+                candidate = posixpath.normpath(candidate)
+                if not candidate.startswith(".."):
+                    rv.add(candidate)
+        return rv
+
+
+ref_scanner = None
+
+
+def init_ref_scanner(extensions):
+    global ref_scanner
+    ref_scanner = RefScanner(extensions)
+
+
+def scan_refs(rel_path):
+    try:
+        refs = ref_scanner.scan(os.path.join(wpt_root, rel_path), rel_path)
+    except IOError:
+        refs = None
+    return rel_path, refs
+
+
+class TestRefIndex(object):
+    """On-disk index mapping support files to the tests that reference them.
+
+    For every test file in the manifest, and every support file that may
+    itself load others (scripts, documents and stylesheets), the index
+    records the paths that the file mentions, either relative to its
+    directory or rooted at the top of the repository. This covers
+    <script src>, <link href>, importScripts() and similar references.
+    Only references with a file extension that occurs among the support
+    files are kept, so that the index stays small but still covers support
+    files added after it was built.
+
+    The references form a graph, so a test is affected by a change to a
+    support file that it loads indirectly through other support files.
+
+    The index is keyed by the revision it was built against, and subsequent
+    runs only rescan the files that git reports as changed since then. The
+    files that differed from that revision in the working tree, including
+    untracked ones, are recorded as well and always rescanned, since they
+    may since have been reverted. The transitive closures computed for
+    support files are stored with it, and only the ones that a rescanned
+    file can affect are dropped.
+
+    :param path: Path to the JSON file holding the index
+    """
+    format_version = 4
     skip_dirs = ["conformance-checkers", "docs", "tools"]
     test_types = ["testharness", "reftest", "wdspec"]
+    # Support files that can reference other support files
+    scan_extensions = [".css", ".htm", ".html", ".js", ".py", ".svg", ".xht", ".xhtml",
+                       ".xml"]
+    pool_threshold = 200
+
+    def __init__(self, path, processes=None):
+        self.path = path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.rev = None
+        self.dirty = set()
+        self.extensions = set()
+        self.refs = {}
+        self._referrers = None
+        self._closures = {}
+
+    @classmethod
+    def load(cls, path, processes=None):
+        rv = cls(path, processes)
+        if path is None or not os.path.exists(path):
+            return rv
+        try:
+            with open(path, "rb") as f:
+                data = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring corrupt test reference index %s" % path)
+            return rv
+        if data.get("version") != cls.format_version:
+            return rv
+        rv.rev = data["rev"]
+        rv.dirty = set(data["dirty"])
+        rv.extensions = set(data["extensions"])
+        rv.refs = data["refs"]
+        rv._closures = {path: set(referrers)
+                        for path, referrers in data["closures"].iteritems()}
+        return rv
+
+    def write(self):
+        if self.path is None:
+            return
+        data = {"version": self.format_version,
+                "rev": self.rev,
+                "dirty": sorted(self.dirty),
+                "extensions": sorted(self.extensions),
+                "refs": self.refs,
+                "closures": {path: sorted(referrers)
+                             for path, referrers in self._closures.iteritems()}}
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def scan(self, rel_paths):
+        """Record the references made by each of rel_paths.
+
+        Large batches are spread over a process pool."""
+        rel_paths = list(rel_paths)
+        if self.processes > 1 and len(rel_paths) >= self.pool_threshold:
+            pool = multiprocessing.Pool(self.processes, init_ref_scanner,
+                                        (sorted(self.extensions),))
+            try:
+                results = pool.imap_unordered(scan_refs, rel_paths, chunksize=64)
+                self._add_refs(results)
+            finally:
+                pool.terminate()
+        else:
+            init_ref_scanner(self.extensions)
+            self._add_refs(scan_refs(rel_path) for rel_path in rel_paths)
+
+    def _add_refs(self, results):
+        touched = set()
+        for rel_path, refs in results:
+            path = rel_path.replace(os.path.sep, "/")
+            touched.add(path)
+            if refs is not None:
+                refs = sorted(refs)
+                touched.update(self.refs.get(path, ()))
+                touched.update(refs)
+                self.refs[path] = refs
+        self._invalidate(touched)
+
+    def _invalidate(self, touched):
+        """Forget the closures that changes to the references of, or to the
+        files referenced by, the paths in touched may have altered."""
+        if not touched:
+            return
+        self._referrers = None
+        self._closures = {path: referrers for path, referrers in self._closures.iteritems()
+                          if path not in touched and not referrers & touched}
+
+    def build(self, support_files, test_files, rev):
+        logger.debug("Building test reference index")
+        self.rev = rev
+        self.dirty = self.local_changes()[1]
+        self.extensions = {os.path.splitext(path)[1] for path in support_files}
+        self.refs = {}
+        self._referrers = None
+        self._closures = {}
+        self.scan(sorted(test_files) + self.scanned_support(support_files))
+
+    def scanned_support(self, support_files):
+        """Return the support files whose references are recorded."""
+        return sorted(path for path in support_files
+                      if os.path.splitext(path)[1] in self.scan_extensions and
+                      path.split(os.path.sep)[0] not in self.skip_dirs)
+
+    def local_changes(self):
+        """Return the set of untracked paths, and the set of all the paths
+        that differ between HEAD and the working tree, including the
+        untracked ones. The files generated alongside MANIFEST.json are left
+        out, in case they aren't ignored by git."""
+        diff = subprocess.check_output(["git", "diff", "--name-only", "-z", "HEAD"],
+                                       cwd=wpt_root)
+        untracked = subprocess.check_output(
+            ["git", "ls-files", "--others", "--exclude-standard", "-z"], cwd=wpt_root)
+        generated = manifest_build.is_generated(wpt_root, os.path.join(wpt_root, "MANIFEST.json"))
+        untracked = {os.path.normpath(path) for path in untracked.split("\0")[:-1]}
+        dirty = {os.path.normpath(path) for path in diff.split("\0")[:-1]}
+        untracked = {path for path in untracked if not generated(path)}
+        dirty = {path for path in dirty if not generated(path)}
+        return untracked, dirty | untracked
+
+    def update(self, support_files, test_files, rev):
+        """Bring the index up to date with the working tree.
+
+        Tests and support files changed since the indexed revision,
+        untracked ones, and those that were modified in the working tree
+        when the index was last updated are rescanned, and removed files
+        are dropped. The index is rebuilt from scratch when the revision is
+        unknown or a support file with a previously unseen extension was
+        added, since existing entries can't refer to it."""
+        if self.rev is None:
+            return self.build(support_files, test_files, rev)
+        try:
+            diff = subprocess.check_output(
+                ["git", "diff", "--name-status", "--no-renames", "-z", self.rev],
+                cwd=wpt_root, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            logger.debug("Revision %s not found; rebuilding test reference index" % self.rev)
+            return self.build(support_files, test_files, rev)
+
+        fields = diff.split("\0")[:-1]
+        changed = {os.path.normpath(rel_path): status
+                   for status, rel_path in zip(fields[::2], fields[1::2])}
+        untracked, dirty = self.local_changes()
+        changed.update((rel_path, "A") for rel_path in untracked)
+        for rel_path in self.dirty:
+            changed.setdefault(rel_path, "M")
+        logger.debug("Updating test reference index for %i changed files" % len(changed))
+        rescan = []
+        removed = set()
+        scanned = set(self.scanned_support(support_files))
+        for rel_path, status in sorted(changed.iteritems()):
+            if (status == "A" and rel_path in support_files and
+                os.path.splitext(rel_path)[1] not in self.extensions):
+                return self.build(support_files, test_files, rev)
+            if rel_path in test_files or rel_path in scanned:
+                rescan.append(rel_path)
+            else:
+                path = rel_path.replace(os.path.sep, "/")
+                removed.add(path)
+                removed.update(self.refs.pop(path, ()))
+        self._invalidate(removed)
+        self.scan(rescan)
+        self.rev = rev
+        self.dirty = dirty
+
+    @property
+    def referrers(self):
+        if self._referrers is None:
+            self._referrers = defaultdict(set)
+            for test, paths in self.refs.iteritems():
+                for path in paths:
+                    self._referrers[path].add(test)
+        return self._referrers
+
+    def closure(self, path, test_files):
+        """Return the set of files that reference path, either directly or
+        through a chain of support files. The search doesn't continue past
+        tests, and the result is memoized.
+
+        :param path: "/"-separated path of a support file
+        :param test_files: Set of the paths of the tests
+        """
+        rv = self._closures.get(path)
+        if rv is not None:
+            return rv
+        rv = set()
+        queue = [path]
+        while queue:
+            for referrer in self.referrers.get(queue.pop(), ()):
+                if referrer not in rv:
+                    rv.add(referrer)
+                    if referrer.replace("/", os.path.sep) not in test_files:
+                        queue.append(referrer)
+        self._closures[path] = rv
+        return rv
+
+    def affected(self, rel_paths, test_files):
+        """Return the set of tests that reference any of rel_paths, directly
+        or indirectly through other support files."""
+        rv = set()
+        for rel_path in rel_paths:
+            rv |= self.closure(rel_path.replace(os.path.sep, "/"), test_files)
+        return {path for path in rv if path.replace("/", os.path.sep) in test_files}
+
+
+def load_manifest():
+    """Return the ShardedManifest of MANIFEST.json, writing the shards first
+    if they are missing or stale."""
+    global wpt_manifest
+    if wpt_manifest is None:
+        manifest_path = os.path.join(wpt_root, "MANIFEST.json")
+        wpt_manifest = manifest_shards.ShardedManifest.load(manifest_path)
+        if wpt_manifest is None:
+            manifest_shards.write(manifest_path)
+            wpt_manifest = manifest_shards.ShardedManifest.load(manifest_path)
+    return wpt_manifest
+
+
+def manifest_tests(test_files):
+    """Iterate over the (path, item type, JSON items) of each of test_files
+    that is a test in the manifest, only reading the shards that hold them.
+
+    :param test_files: Absolute paths, as in wptrunner's test_list
+    """
+    wpt_manifest = load_manifest()
+    for path in test_files:
+        rel_path = os.path.relpath(path, wpt_root)
+        item_type = wpt_manifest.type_of(rel_path)
+        if item_type in TestRefIndex.test_types:
+            yield path, item_type, wpt_manifest.items(rel_path)
+
+
+def item_timeout(item):
+    """Return the timeout, if any, of the JSON form of a manifest item,
+    which is recorded in the dict of extras that ends it."""
+    return item[-1].get("timeout") if isinstance(item[-1], dict) else None
+
+
+def test_files_for_urls(urls):
+    """Return the absolute paths of the test files that contain the tests
+    with the given URLs. A URL that isn't the path of a test file, like
+    those of .any.js variants, is matched to every test file under its
+    directory."""
+    wpt_manifest = load_manifest()
+    rv = set()
+    dirs = set()
+    for url in urls:
+        rel_path = urlsplit(url).path.lstrip("/")
+        if wpt_manifest.type_of(rel_path) in TestRefIndex.test_types:
+            rv.add(rel_path)
+        else:
+            dirs.add(rel_path.rsplit("/", 1)[0] + "/" if "/" in rel_path else "")
+    for prefix in dirs:
+        rv.update(path for _, path in wpt_manifest.iterprefix(prefix, *TestRefIndex.test_types))
+    return {os.path.join(wpt_root, path.replace("/", os.path.sep)) for path in rv}
+
+
+def test_paths_by_url(test_files):
+    """Map the URL of every test in test_files to the path, relative to
+    wpt_root, of the file that contains it."""
+    return {item[0]: os.path.relpath(path, wpt_root)
+            for path, _, items in manifest_tests(test_files)
+            for item in items}
+
+
+def test_timeouts_by_url(test_files, timeout_multiplier=1):
+    """Map the URL of every test in test_files to its timeout in seconds,
+    using wptrunner's default timeouts."""
+    return {item[0]: (60 if item_timeout(item) == "long" else 10) * timeout_multiplier
+            for _, _, items in manifest_tests(test_files)
+            for item in items}
 
-    wpt_manifest = manifest.load(wpt_root, manifest_file)
 
-    support_files = {os.path.join(wpt_root, path)
-                     for _, path, _ in wpt_manifest.itertypes("support")}
-    test_files = {os.path.join(wpt_root, path)
-                  for _, path, _ in wpt_manifest.itertypes(*test_types)}
+def get_affected_testfiles(files_changed, index_path=None):
+    skip_dirs = TestRefIndex.skip_dirs
 
-    nontests_changed = nontests_changed.intersection(support_files)
+    # The sharded manifest only loads the directories that are looked up
+    sharded = load_manifest()
+    support_files = manifest_shards.PathSet(sharded, ["support"])
+    test_files = manifest_shards.PathSet(sharded, TestRefIndex.test_types, skip_dirs)
 
-    nontest_changed_paths = set()
-    for full_path in nontests_changed:
+    nontests_changed = set()
+    for full_path in files_changed:
         rel_path = os.path.relpath(full_path, wpt_root)
+        if rel_path not in support_files:
+            continue
         path_components = rel_path.split(os.sep)
         if len(path_components) < 2:
             # This changed file is in the repo root, so skip it
@@ -434,32 +1472,18 @@ def get_affected_testfiles(files_changed):
         top_level_subdir = path_components[0]
         if top_level_subdir in skip_dirs:
             continue
-        repo_path = "/" + os.path.relpath(full_path, wpt_root).replace(os.path.sep, "/")
-        nontest_changed_paths.add((full_path, repo_path))
-
-    for root, dirs, fnames in os.walk(wpt_root):
-        # Walk top_level_subdir looking for test files containing either the
-        # relative filepath or absolute filepatch to the changed files.
-        if root == wpt_root:
-            for dir_name in skip_dirs:
-                dirs.remove(dir_name)
-        for fname in fnames:
-            test_full_path = os.path.join(root, fname)
-            # Skip any file that's not a test file.
-            if test_full_path not in test_files:
-                continue
-            with open(test_full_path, "rb") as fh:
-                file_contents = fh.read()
-                if file_contents.startswith("\xfe\xff"):
-                    file_contents = file_contents.decode("utf-16be")
-                elif file_contents.startswith("\xff\xfe"):
-                    file_contents = file_contents.decode("utf-16le")
-                for full_path, repo_path in nontest_changed_paths:
-                    rel_path = os.path.relpath(full_path, root).replace(os.path.sep, "/")
-                    if rel_path in file_contents or repo_path in file_contents:
-                        affected_testfiles.add(test_full_path)
-                        continue
-    return affected_testfiles
+        nontests_changed.add(rel_path)
+
+    if not nontests_changed:
+        return set()
+
+    index = TestRefIndex.load(index_path)
+    index.update(support_files, test_files, get_sha1())
+    affected = index.affected(nontests_changed, test_files)
+    # Written after the lookup so that the closures it computed are kept
+    index.write()
+
+    return {os.path.join(wpt_root, path.replace("/", os.path.sep)) for path in affected}
 
 
 def wptrunner_args(root, files_changed, iterations, browser):
@@ -479,18 +1503,548 @@ def wptrunner_args(root, files_changed, iterations, browser):
     return args
 
 
+def run_wptrunner(kwargs, log_path, handler=None):
+    """Run wptrunner with the given arguments, writing the raw log to
+    log_path.
+
+    :param handler: Optional LogHandler that is passed every log message as
+                    it is emitted"""
+    with create_log(log_path) as log:
+        wptrunner.setup_logging(kwargs,
+                                {"raw": log})
+        # Setup logging for wptrunner that keeps process output and
+        # warning+ level logs only
+        wptrunner.logger.add_handler(
+            LogActionFilter(
+                LogLevelFilter(
+                    StreamHandler(
+                        sys.stdout,
+                        TbplFormatter()
+                    ),
+                    "WARNING"),
+                ["log", "process_output"]))
+        if handler is not None:
+            wptrunner.logger.add_handler(handler)
+        try:
+            wptrunner.run_tests(**kwargs)
+        finally:
+            if handler is not None:
+                wptrunner.logger.remove_handler(handler)
+
+
+def split_iterations(iterations, parallel):
+    """Split a number of iterations into at most parallel near-equal parts."""
+    parallel = max(1, min(parallel, iterations))
+    base, extra = divmod(iterations, parallel)
+    return [base + 1 if i < extra else base for i in range(parallel)]
+
+
+def offset_ports(config, port_offset):
+    """Shift every fixed port in a server configuration by port_offset."""
+    for scheme, ports in config["ports"].iteritems():
+        config["ports"][scheme] = [port + port_offset if isinstance(port, int) else port
+                                   for port in ports]
+    return config
+
+
+def run_worker(kwargs, log_path, cwd, port_offset):
+    """Run wptrunner in a worker process, with its servers and the ports
+    used to control the browser shifted by port_offset.
+
+    wptrunner merges its own config.json, which fixes the ports, over the
+    config.default.json of the tests, so the ports are shifted in the
+    configuration that its TestEnvironment ends up with. The servers and the
+    URLs of the tests are both derived from that.
+
+    The Marionette and WebDriver ports are picked with get_free_port, from
+    2828 and 4444 upwards, by checking whether a port can be bound. Workers
+    starting at the same time could all pick the same port before any
+    browser listens on it, so each worker starts its search at its own
+    offset."""
+    from wptrunner import environment
+    from wptrunner.browsers import base
+    # wptrunner has no option for any of these ports, so this patches
+    # wptrunner.environment.TestEnvironment.load_config and
+    # wptrunner.browsers.base.get_free_port, along with the copies of the
+    # latter that wptrunner.browsers.firefox and wptrunner.browsers.webdriver
+    # import. Check that they still take the arguments they did in wptrunner
+    # 1.14, so that an upgrade changing them fails here rather than leaving
+    # the workers to fight over ports
+    load_config = environment.TestEnvironment.load_config
+    get_free_port = base.get_free_port
+    if (inspect.getargspec(load_config).args != ["self"] or
+        inspect.getargspec(get_free_port).args != ["start_port", "exclude"]):
+        raise ValueError("Unsupported wptrunner version: can't assign ports to workers")
+
+    def load_worker_config(self):
+        return offset_ports(load_config(self), port_offset)
+
+    def get_worker_port(start_port, exclude=None):
+        return get_free_port(start_port + port_offset, exclude)
+
+    environment.TestEnvironment.load_config = load_worker_config
+    # Browser modules import get_free_port from base, so patch those that
+    # are already loaded as well
+    for name, module in sys.modules.items():
+        if (name.startswith("wptrunner.") and
+            getattr(module, "get_free_port", None) is get_free_port):
+            module.get_free_port = get_worker_port
+    assert base.get_free_port is get_worker_port
+    os.chdir(cwd)
+    run_wptrunner(kwargs, log_path)
+
+
+def run_workers(kwargs, jobs, name="raw"):
+    """Run several wptrunner processes concurrently.
+
+    Every worker gets its own server and browser control ports, working
+    directory (and so browser profile) and raw log. If any worker fails the
+    run fails, rather than its partial results being reported.
+
+    :param jobs: List of (test_list, iterations) tuples, one per worker
+    :returns: Tuple of the list of paths to the raw logs written by the
+              workers and the list of their wall-clock times in seconds."""
+    log_paths = []
+    workers = []
+    for i, (test_list, worker_iterations) in enumerate(jobs):
+        worker_dir = os.path.abspath("worker-%i" % i)
+        if not os.path.exists(worker_dir):
+            os.makedirs(worker_dir)
+        worker_kwargs = kwargs.copy()
+        worker_kwargs.update({
+            "repeat": worker_iterations,
+            "test_list": test_list,
+            "manifest_update": False
+        })
+        log_path = os.path.abspath("%s-%i%s" % (name, i, log_suffix))
+        log_paths.append(log_path)
+        logger.debug("Starting worker %i with %i tests and %i iterations" %
+                     (i, len(test_list), worker_iterations))
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(worker_kwargs, log_path, worker_dir, 100 * i))
+        worker.start()
+        workers.append(worker)
+
+    start = time.time()
+    elapsed = [None] * len(workers)
+    while None in elapsed:
+        for i, worker in enumerate(workers):
+            if elapsed[i] is None:
+                worker.join(0.5)
+                if not worker.is_alive():
+                    elapsed[i] = time.time() - start
+                    if worker.exitcode != 0:
+                        logger.critical("Worker %i exited with code %s" % (i, worker.exitcode))
+
+    failed = sum(1 for worker in workers if worker.exitcode != 0)
+    if failed:
+        raise RuntimeError("%i of %i wptrunner workers failed" % (failed, len(workers)))
+    return log_paths, elapsed
+
+
+def run_parallel(kwargs, iterations, parallel, name="raw"):
+    """Split iterations across several concurrent wptrunner processes.
+
+    :returns: List of paths to the raw logs written by the workers."""
+    jobs = [(kwargs["test_list"], worker_iterations)
+            for worker_iterations in split_iterations(iterations, parallel)]
+    return run_workers(kwargs, jobs, name)[0]
+
+
+def lpt_schedule(durations, workers):
+    """Assign jobs to workers using the longest-processing-time-first rule.
+
+    Jobs are taken in order of decreasing duration and each is given to the
+    worker with the least work so far.
+
+    :param durations: Dict mapping each job to its estimated duration
+    :returns: List of (total duration, jobs) tuples, one per worker"""
+    heap = [(0, i, []) for i in range(workers)]
+    for job, duration in sorted(durations.iteritems(), key=lambda x: (-x[1], x[0])):
+        load, i, jobs = heapq.heappop(heap)
+        jobs.append(job)
+        heapq.heappush(heap, (load + duration, i, jobs))
+    return [(_load, _jobs) for _load, _, _jobs in sorted(heap, key=lambda x: x[1])]
+
+
+# Fallback estimates, in seconds, for tests that have no recorded duration
+default_durations = {"testharness": 2.0,
+                     "reftest": 1.0,
+                     "wdspec": 5.0}
+long_timeout_factor = 6
+
+
+def estimate_durations(test_list, history=None, product=None, last=10):
+    """Estimate how long one run of each file in test_list takes, in seconds.
+
+    Files are estimated as the sum over the tests they contain of the mean
+    recorded duration, when history has one, or otherwise a default based
+    on the test type and on whether the test has a long timeout. Files that
+    aren't tests are estimated as zero."""
+    rv = {path: 0.0 for path in test_list}
+    for path, item_type, items in manifest_tests(test_list):
+        total = 0.0
+        for item in items:
+            mean = history.mean_duration(product, item[0], last) if history else None
+            if mean is not None:
+                total += mean / 1000.0
+            else:
+                duration = default_durations.get(item_type, 1.0)
+                if item_timeout(item) == "long":
+                    duration *= long_timeout_factor
+                total += duration
+        rv[path] = total
+    return rv
+
+
+def run_sharded(kwargs, iterations, durations, parallel, name="raw"):
+    """Split the tests across several concurrent wptrunner processes, each
+    running its share of the tests iterations times.
+
+    Tests are assigned with lpt_schedule, and the predicted and actual
+    makespans are logged.
+
+    :returns: List of paths to the raw logs written by the workers."""
+    shards = [(load, tests) for load, tests in lpt_schedule(durations, parallel) if tests]
+    for i, (load, tests) in enumerate(shards):
+        logger.debug("Shard %i: %i tests, predicted %.1fs per iteration" %
+                     (i, len(tests), load))
+    log_paths, elapsed = run_workers(kwargs,
+                                     [(tests, iterations) for _, tests in shards],
+                                     name)
+    predicted = max(load for load, _ in shards) * iterations if shards else 0
+    logger.debug("Predicted makespan %.1fs, actual %.1fs (workers: %s)" %
+                 (predicted, max(elapsed or [0]),
+                  ", ".join("%.1fs" % item for item in elapsed)))
+    return log_paths
+
+
+def run_iterations(kwargs, iterations, parallel, name="raw", handler=None):
+    """Run the tests in kwargs iterations times, in parallel if requested.
+
+    :param handler: Optional LogHandler to pass the results to directly when
+                    wptrunner runs in this process, rather than reading them
+                    back from the raw log
+    :returns: List of paths to the raw logs that were written and whose
+              results haven't been passed to handler."""
+    if parallel > 1:
+        return run_parallel(kwargs, iterations, parallel, name)
+    kwargs = dict(kwargs, repeat=iterations)
+    log_path = os.path.abspath("%s%s" % (name, log_suffix))
+    run_wptrunner(kwargs, log_path, handler)
+    return [log_path] if handler is None else []
+
+
+class AdaptiveScheduler(object):
+    """Decide after each round of iterations which tests need to run again.
+
+    A test stops being repeated as soon as one of its subtests has produced
+    more than one status, since that already proves it unstable. If
+    max_flake_rate is set, a test that has been consistent so far is also
+    stopped once the upper bound, at the given confidence, of its flake rate
+    drops below max_flake_rate. The bound is computed from the consistent
+    runs seen in this run plus those recorded in history.
+
+    :param handler: LogHandler accumulating the results of every round
+    :param iterations: Maximum number of times to run any test
+    :param test_paths: Mapping from test URL to the file containing it
+    :param max_flake_rate: Flake rate below which consistent tests stop early,
+                           or None to always run them iterations times
+    :param confidence: Confidence level for the flake rate bound
+    :param history: Mapping from test URL to the number of previous runs in
+                    which the test was consistent
+    """
+    def __init__(self, handler, iterations, test_paths, max_flake_rate=None,
+                 confidence=0.95, history=None):
+        self.handler = handler
+        self.iterations = iterations
+        self.test_paths = test_paths
+        self.max_flake_rate = max_flake_rate
+        self.confidence = confidence
+        self.history = history or {}
+        self.scheduled = defaultdict(int)
+
+    def flake_bound(self, runs):
+        """Upper bound on the per-run flake rate of a test that was consistent
+        in all of runs runs."""
+        if runs == 0:
+            return 1.0
+        return 1 - (1 - self.confidence) ** (1.0 / runs)
+
+    def is_settled(self, test, runs):
+        if runs >= self.iterations:
+            return True
+        for row in self.handler.pending[test].itervalues():
+            if len(self.handler.counts(row)) > 1:
+                return True
+        if self.max_flake_rate is not None:
+            consistent_runs = runs + self.history.get(test, 0)
+            return self.flake_bound(consistent_runs) <= self.max_flake_rate
+        return False
+
+    def next_round(self, test_list, round_iterations):
+        """Record that test_list ran round_iterations more times and return
+        the list of test files that need to run again.
+
+        A file is only dropped once all the tests it contains are settled."""
+        for path in test_list:
+            self.scheduled[path] += round_iterations
+        by_path = defaultdict(list)
+        for test in self.handler.pending:
+            path = self.test_paths.get(test, test.lstrip("/"))
+            by_path[os.path.join(wpt_root, path)].append(test)
+        remaining = set()
+        for path, tests in by_path.iteritems():
+            runs = self.scheduled[path]
+            if all(self.is_settled(test, runs) for test in tests):
+                for test in tests:
+                    self.handler.complete(test, runs)
+            else:
+                remaining.add(path)
+        return [path for path in test_list if path in remaining]
+
+
+def run_adaptive(kwargs, handler, scheduler, iterations, round_size, parallel, tee=False):
+    """Run the tests in rounds, until every test has been settled by the
+    scheduler or has run iterations times.
+
+    Each round starts wptrunner, its servers and the browser afresh, so a
+    round runs the tests round_size times, split between parallel
+    processes, and never fewer times than there are processes.
+
+    :param tee: Pass results to handler as they are logged where possible,
+                rather than reading them back from the raw logs"""
+    test_list = kwargs["test_list"]
+    round_size = max(round_size, parallel)
+    runs = 0
+    round_number = 0
+    while test_list and runs < iterations:
+        round_iterations = min(round_size, iterations - runs)
+        logger.debug("Round %i: running %i tests %i times" %
+                     (round_number, len(test_list), round_iterations))
+        log_paths = run_iterations(dict(kwargs, test_list=test_list),
+                                   round_iterations, parallel,
+                                   "raw-round-%i" % round_number,
+                                   handler if tee else None)
+        read_logs(handler, log_paths)
+        runs += round_iterations
+        round_number += 1
+        test_list = scheduler.next_round(test_list, round_iterations)
+    handler.finish()
+
+
+def suspicious_tests(handler, iterations, timeouts, near_timeout):
+    """Return the set of pending tests that need confirming: those with a
+    subtest whose results were inconsistent over iterations runs, and those
+    that took more than near_timeout of their timeout in any run.
+
+    :param timeouts: Mapping from test URL to its timeout in seconds
+    """
+    rv = set()
+    for test, test_rows in handler.pending.iteritems():
+        if any(is_inconsistent(handler.counts(row), iterations)
+               for row in test_rows.itervalues()):
+            rv.add(test)
+            continue
+        durations = handler.pending_durations.get(test, {}).get(None)
+        if (durations and test in timeouts and
+            max(durations) >= near_timeout * timeouts[test] * 1000):
+            rv.add(test)
+    return rv
+
+
+def run_confirm(kwargs, handler, test_paths, timeouts, screen_iterations, iterations,
+                parallel, near_timeout=0.8, tee=False):
+    """Run every test a few times, then run only the suspicious ones again
+    many more times.
+
+    The tests are first screened by running them screen_iterations times.
+    Files containing a test that suspicious_tests flags are then run a
+    further iterations times, and the results of both phases are combined;
+    all other tests are completed with the screening results alone.
+
+    :param test_paths: Mapping from test URL to the file containing it
+    :param timeouts: Mapping from test URL to its timeout in seconds
+    :param near_timeout: Fraction of the timeout above which a test is
+                         rerun even if its results were consistent
+    :param tee: Pass results to handler as they are logged where possible,
+                rather than reading them back from the raw logs
+    """
+    tee_handler = handler if tee else None
+    log_paths = run_iterations(kwargs, screen_iterations, parallel, "raw-screen",
+                               tee_handler)
+    read_logs(handler, log_paths)
+
+    flagged = suspicious_tests(handler, screen_iterations, timeouts, near_timeout)
+    by_path = defaultdict(list)
+    for test in handler.pending:
+        path = test_paths.get(test, test.lstrip("/"))
+        by_path[os.path.join(wpt_root, path)].append(test)
+    confirm_paths = {path for path, tests in by_path.iteritems()
+                     if any(test in flagged for test in tests)}
+    for path, tests in by_path.iteritems():
+        if path not in confirm_paths:
+            for test in tests:
+                handler.complete(test, screen_iterations)
+
+    test_list = [path for path in kwargs["test_list"] if path in confirm_paths]
+    logger.info("%i of %i test files need confirming" %
+                (len(test_list), len(kwargs["test_list"])))
+    if test_list:
+        log_paths = run_iterations(dict(kwargs, test_list=test_list), iterations,
+                                   parallel, "raw-confirm", tee_handler)
+        read_logs(handler, log_paths)
+    for test in handler.pending.keys():
+        handler.complete(test, screen_iterations + iterations)
+
+
+# Statuses that can be reported by test_status and test_end messages; each
+# gets a fixed slot in the per-(test, subtest) count arrays, and any others
+# are given slots after these by the LogHandler that sees them.
+statuses = ("PASS", "FAIL", "OK", "ERROR", "TIMEOUT", "CRASH", "ASSERT", "SKIP",
+            "NOTRUN")
+
+
+Timing = namedtuple("Timing", ["count", "min", "median", "p95", "max", "variance"])
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of a sorted, non-empty sequence."""
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def timing_stats(durations):
+    """Summarise a sequence of durations in milliseconds as a Timing."""
+    values = sorted(durations)
+    count = len(values)
+    mean = sum(values) / float(count)
+    return Timing(count,
+                  values[0],
+                  percentile(values, 50),
+                  percentile(values, 95),
+                  values[-1],
+                  sum((value - mean) ** 2 for value in values) / count)
+
+
 def setup_log_handler():
     global LogHandler
 
     class LogHandler(reader.LogHandler):
-        def __init__(self):
-            self.results = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        """Handler that aggregates status counts while the log is read.
+
+        The counts for each (test, subtest) pair are held in an array with
+        one slot per status, using a status table owned by the handler. The
+        duration of every run of a test, and the time from the start of the
+        test to each subtest result, are recorded in milliseconds. When a
+        test has ended the expected number of times its results are checked
+        for consistency straight away, its counts are converted to dicts,
+        its durations are reduced to Timing summaries and both are passed to
+        on_complete, so only tests still in flight are held in the pending
+        tables.
+
+        :param iterations: Number of times each test is expected to run, or
+                           None if tests are completed explicitly
+        :param on_complete: Callable taking the test name, its number of
+                            iterations, the dict of subtest status counts and
+                            the dict of subtest Timings of each completed
+                            test. Defaults to storing them in self.results
+                            and self.timings.
+        """
+        def __init__(self, iterations=None, on_complete=None):
+            self.iterations = iterations
+            self.results = {}
+            self.timings = {}
+            self.on_complete = on_complete or self._store
+            self.statuses = list(statuses)
+            self.status_slots = {status: i for i, status in enumerate(statuses)}
+            self.inconsistent = []
+            self.test_iterations = {}
+            self.pending = {}
+            self.pending_durations = {}
+            self.start_times = {}
+            self.runs = defaultdict(int)
+
+        def _store(self, test, iterations, test_counts, test_timings):
+            self.results[test] = test_counts
+            self.timings[test] = test_timings
+
+        def counts(self, row):
+            """Convert an array of per-status counts into a dict of the
+            non-zero counts keyed by status."""
+            return {self.statuses[i]: count for i, count in enumerate(row) if count}
+
+        def _duration(self, test, subtest, data):
+            start = self.start_times.get(test)
+            if start is None or "time" not in data:
+                return
+            test_durations = self.pending_durations.setdefault(test, {})
+            durations = test_durations.get(subtest)
+            if durations is None:
+                durations = test_durations[subtest] = array("I")
+            durations.append(max(data["time"] - start, 0))
+
+        def _row(self, test, subtest):
+            test_rows = self.pending.get(test)
+            if test_rows is None:
+                test_rows = self.pending[test] = {}
+            row = test_rows.get(subtest)
+            if row is None:
+                row = test_rows[subtest] = array("I", [0] * len(self.statuses))
+            return row
+
+        def _count(self, test, subtest, status):
+            slot = self.status_slots.get(status)
+            if slot is None:
+                slot = self.status_slots[status] = len(self.statuses)
+                self.statuses.append(status)
+            row = self._row(test, subtest)
+            if slot >= len(row):
+                row.extend([0] * (slot + 1 - len(row)))
+            row[slot] += 1
+
+        def test_start(self, data):
+            if "time" in data:
+                self.start_times[data["test"]] = data["time"]
 
         def test_status(self, data):
-            self.results[data["test"]][data.get("subtest")][data["status"]] += 1
+            self._count(data["test"], data.get("subtest"), data["status"])
+            self._duration(data["test"], data.get("subtest"), data)
 
         def test_end(self, data):
-            self.results[data["test"]][None][data["status"]] += 1
+            test = data["test"]
+            self._count(test, None, data["status"])
+            self._duration(test, None, data)
+            self.start_times.pop(test, None)
+            self.runs[test] += 1
+            if self.runs[test] == self.iterations:
+                self.complete(test)
+
+        def complete(self, test, iterations=None):
+            """Check the results of test for consistency and hand them on.
+
+            :param iterations: Number of times the test was meant to run, if
+                               different from self.iterations
+            """
+            runs = self.runs.pop(test, 0)
+            if iterations is None:
+                iterations = self.iterations or runs
+            test_counts = {subtest: self.counts(row)
+                           for subtest, row in self.pending.pop(test).iteritems()}
+            self.test_iterations[test] = iterations
+            for subtest, counts in test_counts.iteritems():
+                if is_inconsistent(counts, iterations):
+                    logger.debug("Unstable results for %s%s" %
+                                 (test, " | %s" % subtest if subtest else ""))
+                    self.inconsistent.append((test, subtest, counts, iterations))
+            test_timings = {subtest: timing_stats(durations) for subtest, durations
+                            in self.pending_durations.pop(test, {}).iteritems()}
+            self.on_complete(test, iterations, test_counts, test_timings)
+
+        def finish(self):
+            """Complete any tests that ran fewer times than expected."""
+            for test in self.pending.keys():
+                self.complete(test)
 
 
 def is_inconsistent(results_dict, iterations):
@@ -503,24 +2057,313 @@ def err_string(results_dict, iterations):
     for key, value in sorted(results_dict.items()):
         rv.append("%s%s" %
                   (key, ": %s/%s" % (value, iterations) if value != iterations else ""))
-    rv = ", ".join(rv)
     if total_results < iterations:
         rv.append("MISSING: %s/%s" % (iterations - total_results, iterations))
+    rv = ", ".join(rv)
     if len(results_dict) > 1 or total_results != iterations:
         rv = "**%s**" % rv
     return rv
 
 
-def process_results(log, iterations):
-    inconsistent = []
-    handler = LogHandler()
-    reader.handle_log(reader.read(log), handler)
-    results = handler.results
-    for test, test_results in results.iteritems():
-        for subtest, result in test_results.iteritems():
-            if is_inconsistent(result, iterations):
-                inconsistent.append((test, subtest, result))
-    return results, inconsistent
+class CompressedLog(object):
+    """Write-only wrapper around a compressed file whose flush() does nothing.
+
+    mozlog's StreamHandler flushes its stream after every message. BZ2File
+    has no flush() at all, and GzipFile.flush() does a zlib sync flush that
+    restarts compression each time, which makes the log many times larger,
+    so the compressor is only flushed when the file is closed."""
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+def create_log(path):
+    """Open a raw log for writing, compressed with gzip or bzip2 if path ends
+    in .gz or .bz2."""
+    if path.endswith(".gz"):
+        return CompressedLog(gzip.GzipFile(path, "wb", compresslevel=6))
+    if path.endswith(".bz2"):
+        return CompressedLog(bz2.BZ2File(path, "wb"))
+    return open(path, "wb")
+
+
+def iter_log(path, chunk_size=1024 * 1024):
+    """Iterate over the lines of a raw log, which is decompressed on the fly
+    if it starts with the magic bytes of a gzip or bzip2 stream."""
+    with open(path, "rb") as f:
+        magic = f.read(3)
+        f.seek(0)
+        if magic[:2] == "\x1f\x8b":
+            new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif magic == "BZh":
+            new_decompressor = bz2.BZ2Decompressor
+        else:
+            for line in f:
+                yield line
+            return
+
+        decompressor = new_decompressor()
+        pending = ""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = []
+            while chunk:
+                try:
+                    data.append(decompressor.decompress(chunk))
+                except EOFError:
+                    # The previous stream ended exactly at a chunk boundary
+                    decompressor = new_decompressor()
+                    continue
+                # Concatenated streams start again in the unused data
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = new_decompressor()
+            lines = (pending + "".join(data)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if pending:
+            yield pending
+
+
+def read_logs(handler, log_paths):
+    for path in log_paths:
+        reader.handle_log(reader.read(iter_log(path)), handler)
+
+
+def process_results(log_paths, iterations, history=None, product=None, results_file=None,
+                    history_runs=10):
+    """Aggregate the results in one or more raw logs, which together should
+    contain iterations runs of each test.
+
+    :param history: Optional FlakeHistory used to annotate the tests that
+                    were already known to be flaky for product
+    :param history_runs: Number of previous runs of each test to consider
+    :param results_file: Optional path to stream the results of each test to
+                         as JSON Lines (see ResultsWriter), rather than
+                         keeping them in the handler
+    :returns: The LogHandler holding the inconsistent (test, subtest,
+              results, iterations) tuples, the number of iterations of each
+              test, the known flaky tests and, without results_file, the
+              results and timings."""
+    writer = ResultsWriter(results_file) if results_file else None
+    handler = LogHandler(iterations, writer)
+    read_logs(handler, log_paths)
+    handler.finish()
+    if writer is not None:
+        writer.close()
+    annotate_history(handler, history, product, history_runs)
+    return handler
+
+
+class ResultsWriter(object):
+    """Writes the results of each test to a JSON Lines file as it completes.
+
+    Each line is an object holding the test, its number of iterations and a
+    list of its subtests. Every subtest has its name (null for the overall
+    test result), the count of each status and, where known, a duration
+    summary with the fields of Timing in milliseconds. Lines are written as
+    tests complete, so the file can be consumed while a run is in progress.
+
+    :param path: Path to the file to write
+    :param on_complete: Optional callable that each result is passed on to,
+                        taking the same arguments as LogHandler.on_complete
+    """
+    def __init__(self, path, on_complete=None):
+        self.path = path
+        self.on_complete = on_complete
+        self.count = 0
+        self.f = open(path, "wb", 1)
+
+    def __call__(self, test, iterations, test_counts, test_timings):
+        subtests = []
+        for subtest, counts in sorted(test_counts.iteritems()):
+            item = {"subtest": subtest, "counts": counts}
+            timing = test_timings.get(subtest)
+            if timing is not None:
+                item["duration"] = timing._asdict()
+            subtests.append(item)
+        self.f.write(json.dumps({"test": test,
+                                 "iterations": iterations,
+                                 "subtests": subtests},
+                                separators=(",", ":")) + "\n")
+        self.count += 1
+        if self.on_complete is not None:
+            self.on_complete(test, iterations, test_counts, test_timings)
+
+    def close(self):
+        self.f.close()
+
+
+def read_results(path):
+    """Iterate over the records in a results file written by ResultsWriter."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_results(path):
+    """Iterate over the results in a results file, in the form passed to
+    LogHandler.on_complete: tuples of the test, its iterations, the dict of
+    subtest status counts and the dict of subtest Timings."""
+    for record in read_results(path):
+        yield (record["test"],
+               record["iterations"],
+               {item["subtest"]: item["counts"] for item in record["subtests"]},
+               {item["subtest"]: Timing(**item["duration"])
+                for item in record["subtests"] if "duration" in item})
+
+
+def load_timings(path):
+    """Return a dict mapping each test in a results file to a dict holding
+    just the Timing of the test as a whole, as used by write_durations."""
+    return {test: {None: test_timings[None]}
+            for test, _, _, test_timings in iter_results(path)
+            if None in test_timings}
+
+
+def annotate_history(handler, history, product, last=10):
+    handler.known_flaky = {}
+    if history is not None:
+        handler.known_flaky = history.known_flaky(
+            product, {test for test, _, _, _ in handler.inconsistent}, last)
+
+
+class FlakeHistory(object):
+    """Local SQLite store of the results of previous stability runs.
+
+    Every run is recorded with its product and revision, and for each test
+    and subtest the status counts, number of iterations, whether the
+    results were consistent and the duration summary. Queries cover the
+    most recent runs of a product that include the test in question.
+
+    :param path: Path to the database file, created if it doesn't exist
+    """
+    schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    product TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    test TEXT NOT NULL,
+    subtest TEXT,
+    iterations INTEGER NOT NULL,
+    statuses TEXT NOT NULL,
+    consistent INTEGER NOT NULL,
+    duration_median REAL,
+    duration_p95 REAL,
+    duration_max REAL
+);
+CREATE INDEX IF NOT EXISTS runs_revision ON runs (product, revision);
+CREATE INDEX IF NOT EXISTS results_test ON results (test, subtest, run_id);
+"""
+
+    def __init__(self, path):
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(self.schema)
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, product, revision, results):
+        """Store results as a new run.
+
+        :param results: Iterable of (test, iterations, subtest counts,
+                        subtest Timings) tuples, as produced by iter_results
+        """
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (product, revision, time) VALUES (?, ?, ?)",
+                (product, revision, time.time()))
+            run_id = cursor.lastrowid
+            for test, iterations, test_counts, test_timings in results:
+                rows = []
+                for subtest, counts in test_counts.iteritems():
+                    timing = test_timings.get(subtest)
+                    rows.append((run_id, test, subtest, iterations, json.dumps(counts),
+                                 not is_inconsistent(counts, iterations),
+                                 timing.median if timing else None,
+                                 timing.p95 if timing else None,
+                                 timing.max if timing else None))
+                self.conn.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return run_id
+
+    def _recent(self, product, test, last):
+        """Return (iterations, consistent) for each of the last runs of product
+        that included test, most recent first. A run only counts as
+        consistent if every subtest was."""
+        return self.conn.execute(
+            """SELECT MAX(results.iterations), MIN(results.consistent)
+               FROM results JOIN runs ON runs.id = results.run_id
+               WHERE results.test = ? AND runs.product = ?
+               GROUP BY results.run_id
+               ORDER BY results.run_id DESC
+               LIMIT ?""", (test, product, last)).fetchall()
+
+    def flake_rate(self, product, test, last=10):
+        """Fraction of the last runs of test in which it was unstable, or None
+        if it hasn't been run before."""
+        runs = self._recent(product, test, last)
+        if not runs:
+            return None
+        return sum(1 for _, consistent in runs if not consistent) / float(len(runs))
+
+    def mean_duration(self, product, test, last=10):
+        """Mean of the median durations of test over its last runs, in
+        milliseconds, or None if no durations were recorded."""
+        return self.conn.execute(
+            """SELECT AVG(duration_median) FROM (
+                 SELECT results.duration_median FROM results
+                 JOIN runs ON runs.id = results.run_id
+                 WHERE results.test = ? AND results.subtest IS NULL AND
+                       runs.product = ? AND results.duration_median IS NOT NULL
+                 ORDER BY results.run_id DESC
+                 LIMIT ?)""", (test, product, last)).fetchone()[0]
+
+    def known_flaky(self, product, tests, last=10):
+        """Return a dict of the tests that were unstable in any of their
+        last runs, mapping each to a tuple (unstable runs, runs)."""
+        rv = {}
+        for test in tests:
+            runs = self._recent(product, test, last)
+            unstable = sum(1 for _, consistent in runs if not consistent)
+            if unstable:
+                rv[test] = (unstable, len(runs))
+        return rv
+
+    def consistent_iterations(self, product, tests, last=10):
+        """Return a dict mapping each test that was consistent in all of its
+        last runs to the total number of iterations in those runs."""
+        rv = {}
+        for test in tests:
+            runs = self._recent(product, test, last)
+            if runs and all(consistent for _, consistent in runs):
+                rv[test] = sum(iterations for iterations, _ in runs)
+        return rv
 
 
 def format_comment_title(product):
@@ -562,16 +2405,45 @@ def table(headings, data, log):
     log("")
 
 
-def write_inconsistent(inconsistent, iterations):
+def write_inconsistent(inconsistent, known_flaky=None):
     logger.error("## Unstable results ##\n")
     strings = [("`%s`" % markdown_adjust(test), ("`%s`" % markdown_adjust(subtest)) if subtest else "", err_string(results, iterations))
-               for test, subtest, results in inconsistent]
-    table(["Test", "Subtest", "Results"], strings, logger.error)
-
-
-def write_results(results, iterations, comment_pr):
+               for test, subtest, results, iterations in inconsistent]
+    headings = ["Test", "Subtest", "Results"]
+    if known_flaky:
+        headings.append("Previously")
+        strings = [item + ("unstable in %s/%s runs" % known_flaky[test]
+                           if test in known_flaky else "",)
+                   for item, (test, _, _, _) in zip(strings, inconsistent)]
+    table(headings, strings, logger.error)
+
+
+def format_timing(timing):
+    return ("%.2fs (min %.2fs, p95 %.2fs, max %.2fs, sd %.2fs)" %
+            (timing.median / 1000.0, timing.min / 1000.0, timing.p95 / 1000.0,
+             timing.max / 1000.0, math.sqrt(timing.variance) / 1000.0))
+
+
+def write_results(results, comment_pr):
+    """Write a table of the results of each test, with a column of subtest
+    durations where they are known. The tables for tests whose results were
+    all stable are only logged at debug level, so that the PR comment just
+    counts them.
+
+    :param results: Iterable of (test, iterations, subtest counts, subtest
+                    Timings) tuples, as produced by iter_results
+    """
     logger.info("## All results ##\n")
-    for test, test_results in results.iteritems():
+    stable = 0
+    count = 0
+    for test, iterations, test_results, test_timings in results:
+        count += 1
+        if any(is_inconsistent(counts, iterations)
+               for counts in test_results.itervalues()):
+            log = logger.info
+        else:
+            log = logger.debug
+            stable += 1
         baseurl = "http://w3c-test.org/submissions"
         if "https" in os.path.splitext(test)[0].split(".")[1:]:
             baseurl = "https://w3c-test.org/submissions"
@@ -582,19 +2454,70 @@ def write_results(results, iterations, comment_pr):
             except ValueError:
                 pass
         if pr_number:
-            logger.info("<details>\n")
-            logger.info('<summary><a href="%s/%s%s">%s</a></summary>\n\n' %
-                        (baseurl, pr_number, test, test))
+            log("<details>\n")
+            log('<summary><a href="%s/%s%s">%s</a></summary>\n\n' %
+                (baseurl, pr_number, test, test))
         else:
-            logger.info("### %s ###" % test)
+            log("### %s ###" % test)
         parent = test_results.pop(None)
         strings = [("", err_string(parent, iterations))]
         strings.extend(((("`%s`" % markdown_adjust(subtest)) if subtest
-                         else "", err_string(results, iterations))
-                        for subtest, results in test_results.iteritems()))
-        table(["Subtest", "Results"], strings, logger.info)
+                         else "", err_string(counts, iterations))
+                        for subtest, counts in test_results.iteritems()))
+        headings = ["Subtest", "Results"]
+        if test_timings:
+            headings.append("Duration")
+            subtests = [None] + test_results.keys()
+            strings = [item + (format_timing(test_timings[subtest])
+                               if subtest in test_timings else "",)
+                       for subtest, item in zip(subtests, strings)]
+        table(headings, strings, log)
         if pr_number:
-            logger.info("</details>\n")
+            log("</details>\n")
+    if stable:
+        logger.info("%i of %i tests had stable results\n" % (stable, count))
+
+
+def write_durations(timings, timeouts=None, limit=10):
+    """Write tables of the slowest tests and of the tests whose duration
+    varies most between iterations.
+
+    :param timings: Dict of test to the dict of subtest Timings
+    :param timeouts: Optional dict of test to its timeout in seconds, used to
+                     show how close each test came to timing out
+    """
+    test_timings = [(test, item[None]) for test, item in timings.iteritems()
+                    if None in item]
+    if not test_timings:
+        return
+    timeouts = timeouts or {}
+
+    def timeout_use(test, timing):
+        if test not in timeouts:
+            return ""
+        return "%i%%" % (100 * timing.max / (1000.0 * timeouts[test]))
+
+    logger.info("## Slowest tests ##\n")
+    slowest = sorted(test_timings, key=lambda x: -x[1].p95)[:limit]
+    table(["Test", "Median", "p95", "Max", "Of timeout"],
+          [("`%s`" % markdown_adjust(test),
+            "%.2fs" % (timing.median / 1000.0),
+            "%.2fs" % (timing.p95 / 1000.0),
+            "%.2fs" % (timing.max / 1000.0),
+            timeout_use(test, timing))
+           for test, timing in slowest],
+          logger.info)
+
+    logger.info("## Highest timing variance ##\n")
+    variable = sorted(test_timings, key=lambda x: -x[1].variance)[:limit]
+    table(["Test", "Std dev", "Min", "Max", "Runs"],
+          [("`%s`" % markdown_adjust(test),
+            "%.2fs" % (math.sqrt(timing.variance) / 1000.0),
+            "%.2fs" % (timing.min / 1000.0),
+            "%.2fs" % (timing.max / 1000.0),
+            str(timing.count))
+           for test, timing in variable],
+          logger.info)
 
 
 def get_parser():
@@ -608,10 +2531,119 @@ def get_parser():
                         default=10,
                         type=int,
                         help="Number of times to run tests")
+    parser.add_argument("--parallel",
+                        action="store",
+                        default=1,
+                        type=int,
+                        help="Number of concurrent wptrunner processes to split the iterations between")
+    # Each of these chooses how the iterations are scheduled
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--shard-tests",
+                      action="store_true",
+                      help="With --parallel, split the tests rather than the iterations between "
+                      "processes, balancing them by their expected duration")
+    mode.add_argument("--adaptive",
+                      action="store_true",
+                      help="Run iterations in rounds and stop repeating tests once their "
+                      "results are known to be unstable")
+    parser.add_argument("--round-iterations",
+                        action="store",
+                        default=3,
+                        type=int,
+                        help="Number of iterations in each round of --adaptive, split between the "
+                        "--parallel processes")
+    mode.add_argument("--confirm",
+                      action="store_true",
+                      help="Run all tests --screen-iterations times, then only the tests that "
+                      "were unstable or close to timing out a further --iterations times")
+    parser.add_argument("--screen-iterations",
+                        action="store",
+                        default=3,
+                        type=int,
+                        help="Number of times to run each test before confirming (with --confirm)")
+    parser.add_argument("--near-timeout",
+                        action="store",
+                        default=0.8,
+                        type=float,
+                        help="Fraction of the timeout above which a test is confirmed "
+                        "(with --confirm)")
+    parser.add_argument("--max-flake-rate",
+                        action="store",
+                        type=float,
+                        default=None,
+                        help="With --adaptive, also stop repeating consistent tests once their "
+                        "flake rate is bounded below this value")
+    parser.add_argument("--confidence",
+                        action="store",
+                        type=float,
+                        default=0.95,
+                        help="Confidence level used for --max-flake-rate")
+    parser.add_argument("--history-db",
+                        action="store",
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "wpt", "history.sqlite"),
+                        help="SQLite database of previous results, or an empty string to disable it")
+    parser.add_argument("--history-runs",
+                        action="store",
+                        type=int,
+                        default=10,
+                        help="Number of previous runs of each test to take into account")
+    parser.add_argument("--log-compression",
+                        action="store",
+                        choices=["none", "gzip", "bz2"],
+                        default="none",
+                        help="Compression to use for the raw logs")
+    parser.add_argument("--tee-log",
+                        action="store_true",
+                        help="Aggregate results as they are logged instead of reading the raw "
+                        "log back afterwards, where wptrunner runs in this process")
+    parser.add_argument("--replay",
+                        action="store",
+                        nargs="+",
+                        metavar="LOG",
+                        help="Report the results in existing raw logs, which together "
+                        "should contain --iterations runs of each test, instead of running tests")
+    parser.add_argument("--results-file",
+                        action="store",
+                        default="results.jsonl",
+                        help="Path to write the JSON Lines results of each test to")
+    parser.add_argument("--no-markdown",
+                        action="store_false",
+                        dest="markdown",
+                        default=True,
+                        help="Don't write the full results as Markdown tables")
+    parser.add_argument("--cache-dir",
+                        action="store",
+                        # Kept out of ~/.cache/wpt, which Travis uploads after every build
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "wpt-artifacts"),
+                        help="Directory in which to cache browser and webdriver downloads. "
+                        "The default is not kept between Travis builds, so it only helps "
+                        "runners with a persistent home directory; ci_stability.sh keeps a "
+                        "small cache of the downloads alone under ~/.cache/wpt instead")
+    parser.add_argument("--cache-size",
+                        action="store",
+                        type=int,
+                        default=2048,
+                        help="Maximum size of the artifact cache in MB")
+    parser.add_argument("--no-cache-trees",
+                        action="store_false",
+                        dest="cache_trees",
+                        help="Only cache downloaded archives, not their extracted contents")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="Install browsers and webdrivers from the artifact cache only")
     parser.add_argument("--gh-token",
                         action="store",
                         default=os.environ.get("GH_TOKEN"),
                         help="OAuth token to use for accessing GitHub api")
+    parser.add_argument("--gh-api-root",
+                        action="store",
+                        default="https://api.github.com/",
+                        help="Root URL of the GitHub API")
+    parser.add_argument("--gh-cache",
+                        action="store",
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "wpt", "github.json"),
+                        help="File in which GitHub API responses are kept between runs for "
+                        "conditional requests, or an empty string to disable it")
     parser.add_argument("--comment-pr",
                         action="store",
                         default=os.environ.get("TRAVIS_PULL_REQUEST"),
@@ -620,25 +2652,82 @@ def get_parser():
                         action="store",
                         # Travis docs say do not depend on USER env variable.
                         # This is a workaround to get what should be the same value
-                        default=os.environ.get("TRAVIS_REPO_SLUG").split('/')[0],
+                        default=os.environ.get("TRAVIS_REPO_SLUG", "").split('/')[0],
                         help="Travis user name")
+    parser.add_argument("--ref-index",
+                        action="store",
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "wpt", "test_refs.json"),
+                        help="Path to the persistent index of support files referenced by tests")
+    parser.add_argument("--manifest-cache",
+                        action="store",
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "wpt", "MANIFEST.json"),
+                        help="Path to a copy of MANIFEST.json kept between runs for incremental updates")
     parser.add_argument("product",
                         action="store",
                         help="Product to run against (`browser-name` or 'browser-name:channel')")
     return parser
 
 
+def report_results(handler, args, timeouts=None):
+    """Log the unstable results, durations and full results aggregated by
+    handler, returning the exit code for the run.
+
+    :param timeouts: Optional mapping from test URL to its timeout in seconds
+    """
+    if not handler.test_iterations:
+        logger.info("No tests run.")
+        return 0
+
+    retcode = 0
+    if handler.inconsistent:
+        write_inconsistent(handler.inconsistent, handler.known_flaky)
+        retcode = 2
+    else:
+        logger.info("All results were stable\n")
+    with TravisFold("durations"):
+        write_durations(load_timings(args.results_file), timeouts)
+    logger.debug("Results written to %s" % args.results_file)
+    if args.markdown:
+        with TravisFold("full_results"):
+            write_results(iter_results(args.results_file), args.comment_pr)
+    return retcode
+
+
+def replay(args):
+    """Aggregate and report the results in existing raw logs, without
+    installing or running anything."""
+    global reader
+    from mozlog import reader
+    setup_log_handler()
+
+    history = FlakeHistory(args.history_db) if args.history_db else None
+    handler = process_results(args.replay, args.iterations, history, args.product,
+                              args.results_file, args.history_runs)
+    if history is not None:
+        history.close()
+
+    timeouts = None
+    if os.path.exists(os.path.join(wpt_root, "MANIFEST.json")):
+        timeouts = test_timeouts_by_url(test_files_for_urls(handler.test_iterations))
+    return report_results(handler, args, timeouts)
+
+
 def main():
     global wpt_root
     global wptrunner_root
+    global log_suffix
 
-    retcode = 0
     parser = get_parser()
     args = parser.parse_args()
 
     wpt_root = os.path.abspath(os.curdir)
     wptrunner_root = os.path.normpath(os.path.join(wpt_root, "..", "wptrunner"))
 
+    log_suffix = {"none": ".log", "gzip": ".log.gz", "bz2": ".log.bz2"}[args.log_compression]
+
+    if args.replay:
+        return replay(args)
+
     if not os.path.exists(args.root):
         logger.critical("Root directory %s does not exist" % args.root)
         return 1
@@ -675,14 +2764,19 @@ def main():
             logger.info("No files changed")
             return 0
 
-        build_manifest()
-        install_wptrunner()
+        cache = ArtifactCache(args.cache_dir,
+                              max_size=args.cache_size * 1024 ** 2,
+                              offline=args.offline,
+                              keep_trees=args.cache_trees)
+        browser = browser_cls(args.gh_token, cache)
+
+        run_steps({"manifest": (lambda: build_manifest(args.manifest_cache), ()),
+                   "wptrunner": (install_wptrunner, ()),
+                   "browser": (browser.install, ()),
+                   "webdriver": (browser.install_webdriver, ()),
+                   "requirements": (browser.install_requirements, ("wptrunner",))})
         do_delayed_imports()
 
-        browser = browser_cls(args.gh_token)
-        browser.install()
-        browser.install_webdriver()
-
         try:
             version = browser.version(args.root)
         except Exception, e:
@@ -691,7 +2785,7 @@ def main():
 
         logger.debug("Files changed:\n%s" % "".join(" * %s\n" % item for item in files_changed))
 
-        affected_testfiles = get_affected_testfiles(files_changed)
+        affected_testfiles = get_affected_testfiles(files_changed, args.ref_index)
 
         logger.debug("Affected tests:\n%s" % "".join(" * %s\n" % item for item in affected_testfiles))
 
@@ -704,36 +2798,63 @@ def main():
 
     with TravisFold("running_tests"):
         logger.info("Starting %i test iterations" % args.iterations)
-        with open("raw.log", "wb") as log:
-            wptrunner.setup_logging(kwargs,
-                                    {"raw": log})
-            # Setup logging for wptrunner that keeps process output and
-            # warning+ level logs only
-            wptrunner.logger.add_handler(
-                LogActionFilter(
-                    LogLevelFilter(
-                        StreamHandler(
-                            sys.stdout,
-                            TbplFormatter()
-                        ),
-                        "WARNING"),
-                    ["log", "process_output"]))
-
-            wptrunner.run_tests(**kwargs)
-
-        with open("raw.log", "rb") as log:
-            results, inconsistent = process_results(log, args.iterations)
-
-    if results:
-        if inconsistent:
-            write_inconsistent(inconsistent, args.iterations)
-            retcode = 2
+        history = FlakeHistory(args.history_db) if args.history_db else None
+        if args.adaptive:
+            writer = ResultsWriter(args.results_file)
+            handler = LogHandler(on_complete=writer)
+            test_paths = test_paths_by_url(kwargs["test_list"])
+            consistent = {}
+            if history is not None:
+                consistent = history.consistent_iterations(args.product, list(test_paths),
+                                                           args.history_runs)
+            scheduler = AdaptiveScheduler(handler,
+                                          args.iterations,
+                                          test_paths,
+                                          max_flake_rate=args.max_flake_rate,
+                                          confidence=args.confidence,
+                                          history=consistent)
+            run_adaptive(kwargs, handler, scheduler, args.iterations, args.round_iterations,
+                         args.parallel, args.tee_log)
+            writer.close()
+            annotate_history(handler, history, args.product, args.history_runs)
+        elif args.confirm:
+            writer = ResultsWriter(args.results_file)
+            handler = LogHandler(on_complete=writer)
+            run_confirm(kwargs,
+                        handler,
+                        test_paths_by_url(kwargs["test_list"]),
+                        test_timeouts_by_url(kwargs["test_list"],
+                                             kwargs.get("timeout_multiplier") or 1),
+                        args.screen_iterations,
+                        args.iterations,
+                        args.parallel,
+                        args.near_timeout,
+                        args.tee_log)
+            writer.close()
+            annotate_history(handler, history, args.product, args.history_runs)
+        elif args.shard_tests and args.parallel > 1:
+            durations = estimate_durations(kwargs["test_list"], history, args.product,
+                                           args.history_runs)
+            log_paths = run_sharded(kwargs, args.iterations, durations, args.parallel)
+            handler = process_results(log_paths, args.iterations, history, args.product,
+                                      args.results_file, args.history_runs)
         else:
-            logger.info("All results were stable\n")
-        with TravisFold("full_results"):
-            write_results(results, args.iterations, args.comment_pr)
-    else:
-        logger.info("No tests run.")
+            writer = ResultsWriter(args.results_file)
+            handler = LogHandler(args.iterations, writer)
+            log_paths = run_iterations(kwargs, args.iterations, args.parallel,
+                                       handler=handler if args.tee_log else None)
+            read_logs(handler, log_paths)
+            handler.finish()
+            writer.close()
+            annotate_history(handler, history, args.product, args.history_runs)
+
+        if history is not None:
+            history.record(args.product, head_sha1, iter_results(args.results_file))
+            history.close()
+
+    retcode = report_results(handler, args,
+                             test_timeouts_by_url(kwargs["test_list"],
+                                                  kwargs.get("timeout_multiplier") or 1))
 
     try:
         if gh_handler:
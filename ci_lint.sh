@@ -1,5 +1,5 @@
 set -ex
 
-./manifest
+python manifest_build.py
 ./lint
 ./diff-manifest.py
@@ -35,7 +35,13 @@ install_chrome() {
 }
 
 test_stability() {
-    python check_stability.py $PRODUCT
+    # Travis uploads ~/.cache/wpt whenever it changes, so only keep the
+    # downloads, up to about one browser build and its webdriver
+    python check_stability.py \
+        --cache-dir $HOME/.cache/wpt/artifacts \
+        --cache-size 128 \
+        --no-cache-trees \
+        $PRODUCT
 }
 
 main() {
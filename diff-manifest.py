@@ -1,34 +1,50 @@
 #!/usr/bin/env python
 
-import difflib
 import json
 import os
 import subprocess
 import sys
 
+import manifest_build
+
 
 def call(*args):
     return subprocess.check_output(args)
 
 
-def get_manifest(rev):
-    call("git", "checkout", rev)
-    call("./manifest", "-r")
-    with open("MANIFEST.json", "r") as fp:
-        return fp.readlines()
+def format_items(prefix, item_type, items):
+    return "".join("%s %s %s\n" % (prefix, item_type, json.dumps(item, sort_keys=True))
+                   for item in items)
 
 
 def main():
-    after = get_manifest("HEAD")
-
     call("git", "fetch", "origin", "master:master")
     merge_base = call("git", "merge-base", "master", "HEAD").strip()
-    before = get_manifest(merge_base)
 
-    diff = difflib.unified_diff(before, after,
-                                fromfile='before.json', tofile='after.json')
-    for line in diff:
-        sys.stdout.write(line)
+    # The manifest of the working tree provides the entries of every
+    # path that didn't change
+    manifest_path = os.path.abspath("MANIFEST.json")
+    if manifest_build.update_from_git(".", manifest_path) is None:
+        manifest_build.build(".", manifest_path)
+        manifest_build.record_rev(".", manifest_path)
+    with open(manifest_path, "rb") as f:
+        head_data = json.load(f)
+
+    added, removed, changed = manifest_build.diff_revs(".", merge_base, "HEAD", head_data)
+    for path, (item_type, items) in added:
+        sys.stdout.write("+++ %s\n" % path)
+        sys.stdout.write(format_items("+", item_type, items))
+    for path, (item_type, items) in removed:
+        sys.stdout.write("--- %s\n" % path)
+        sys.stdout.write(format_items("-", item_type, items))
+    for path, (before_type, before), (after_type, after) in changed:
+        if before_type == after_type:
+            # Only show the items that differ
+            before, after = ([item for item in before if item not in after],
+                             [item for item in after if item not in before])
+        sys.stdout.write("~~~ %s\n" % path)
+        sys.stdout.write(format_items("-", before_type, before))
+        sys.stdout.write(format_items("+", after_type, after))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,577 @@
+"""In-process, incremental and parallel builds of MANIFEST.json.
+
+Rather than re-classifying every file in the repository, only the paths that
+git reports as changed are read again; the entries for all other paths are
+carried over from the existing manifest by their hash. When the manifest
+has to be built from scratch, the files are classified on a process pool.
+
+The revision that a manifest reflects is recorded next to it in a
+MANIFEST.json.rev file, so later updates know which changes to apply. The
+paths where the working tree differed from that revision are recorded too,
+and are always read again by the next update, since they may since have
+been reverted to the revision's contents.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import manifest_shards
+from tools.manifest import manifest, sourcefile
+
+logger = logging.getLogger(__name__)
+
+
+class UnchangedFile(object):
+    """Stand-in for the SourceFile of a path that hasn't changed.
+
+    Manifest.update matches it against the existing entry by hash, so the
+    file itself is never read."""
+    def __init__(self, rel_path, file_hash):
+        self.rel_path = rel_path
+        self.hash = file_hash
+
+
+def git(tests_root, *args):
+    """Run git in tests_root and return its output.
+
+    Its stderr is captured rather than shown, since some failures are
+    expected, such as a recorded revision that is no longer in the
+    repository; callers see a CalledProcessError and the message is only
+    logged."""
+    cmd = ["git"] + list(args)
+    proc = subprocess.Popen(cmd, cwd=tests_root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        logger.debug("%s failed: %s" % (" ".join(cmd), err.strip()))
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
+
+
+def git_changes(tests_root, rev, to_rev=None):
+    """Return lists of the changed and deleted paths, relative to tests_root,
+    between rev and to_rev, or between rev and the working tree (including
+    untracked files) if to_rev is None."""
+    args = ["diff", "--name-status", "--no-renames", "-z", rev]
+    if to_rev is not None:
+        args.append(to_rev)
+    fields = git(tests_root, *args).split("\0")[:-1]
+    changed = []
+    deleted = []
+    for status, path in zip(fields[::2], fields[1::2]):
+        (deleted if status == "D" else changed).append(os.path.normpath(path))
+    if to_rev is None:
+        untracked = git(tests_root, "ls-files", "--others", "--exclude-standard", "-z")
+        changed.extend(os.path.normpath(path) for path in untracked.split("\0") if path)
+    return changed, deleted
+
+
+def cache_path(manifest_path):
+    """Return the path of the classification cache for manifest_path."""
+    return os.path.splitext(manifest_path)[0] + ".cache.json"
+
+
+def is_generated(tests_root, manifest_path):
+    """Return a function that tells whether a path relative to tests_root is
+    one of the files generated alongside the manifest, which are normally
+    untracked and mustn't end up in it."""
+    rel_manifest = os.path.relpath(manifest_path, tests_root)
+    names = {rel_manifest,
+             rel_manifest + ".rev",
+             os.path.relpath(cache_path(manifest_path), tests_root)}
+    shard_prefix = os.path.relpath(manifest_shards.shard_dir(manifest_path), tests_root) + os.path.sep
+    return lambda rel_path: rel_path in names or rel_path.startswith(shard_prefix)
+
+
+def read_rev(manifest_path):
+    try:
+        with open(manifest_path + ".rev", "rb") as f:
+            return f.readline().strip() or None
+    except IOError:
+        return None
+
+
+def read_dirty(manifest_path):
+    """Return the paths, relative to the tests root, that differed from the
+    recorded revision in the working tree when the manifest was written."""
+    try:
+        with open(manifest_path + ".rev", "rb") as f:
+            return [line.rstrip("\n") for line in f.readlines()[1:] if line.strip()]
+    except IOError:
+        return []
+
+
+def write_rev(manifest_path, rev, dirty=()):
+    with open(manifest_path + ".rev", "wb") as f:
+        f.write("%s\n" % rev)
+        for path in sorted(dirty):
+            f.write("%s\n" % path)
+
+
+def record_rev(tests_root, manifest_path):
+    """Record that the manifest at manifest_path reflects the working tree,
+    as the HEAD revision and the paths that differ from it."""
+    changed, deleted = git_changes(tests_root, "HEAD")
+    generated = is_generated(tests_root, manifest_path)
+    write_rev(manifest_path, git(tests_root, "rev-parse", "HEAD").strip(),
+              {path for path in changed + deleted if not generated(path)})
+
+
+def write(wpt_manifest, manifest_path):
+    """Write wpt_manifest to manifest_path, replacing any existing file
+    atomically."""
+    write_json(wpt_manifest.to_json(), manifest_path)
+
+
+def write_json(data, manifest_path):
+    """Write the JSON form of a manifest to manifest_path, replacing any
+    existing file atomically."""
+    dir_name = os.path.dirname(os.path.abspath(manifest_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".MANIFEST.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            json.dump(data, f, sort_keys=True, indent=1, separators=(',', ': '))
+            f.write("\n")
+        os.rename(tmp_path, manifest_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def update(tests_root, manifest_path, changed, deleted):
+    """Update the manifest at manifest_path for a set of changed paths.
+
+    :param changed: Paths, relative to tests_root, that were added or modified
+    :param deleted: Paths, relative to tests_root, that were removed
+    :returns: The updated Manifest, or None if the existing manifest can't be
+              updated incrementally and has to be rebuilt.
+    """
+    # The hash of every path is taken from the "paths" of the manifest file
+    # itself, which is part of its format, rather than from the Manifest
+    # object, which only keeps them in private state
+    try:
+        with open(manifest_path, "rb") as f:
+            data = json.load(f)
+        path_hashes = data["paths"]
+        wpt_manifest = manifest.Manifest.from_json(tests_root, data)
+    except Exception as e:
+        logger.debug("Can't load %s: %s" % (manifest_path, e))
+        return None
+
+    changed = {os.path.normpath(path) for path in changed}
+    deleted = {os.path.normpath(path) for path in deleted}
+    tree = []
+    for key, (file_hash, _) in path_hashes.iteritems():
+        rel_path = os.path.normpath(key)
+        if rel_path not in changed and rel_path not in deleted:
+            tree.append(UnchangedFile(rel_path, file_hash))
+    for rel_path in changed:
+        if rel_path not in deleted and os.path.isfile(os.path.join(tests_root, rel_path)):
+            tree.append(sourcefile.SourceFile(tests_root, rel_path, wpt_manifest.url_base))
+
+    logger.debug("Updating %s for %i changed and %i deleted paths" %
+                 (manifest_path, len(changed), len(deleted)))
+    wpt_manifest.update(tree)
+    write(wpt_manifest, manifest_path)
+    return wpt_manifest
+
+
+def iter_blobs(tests_root, rev, paths):
+    """Yield a tuple of (path, blob hash, contents) for each of paths as it
+    is at rev, with a hash and contents of None if there is no such file,
+    reading every file through a single git cat-file process."""
+    proc = subprocess.Popen(["git", "cat-file", "--batch"], cwd=tests_root,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        for path in paths:
+            proc.stdin.write("%s:%s\n" % (rev, path.replace(os.path.sep, "/")))
+            proc.stdin.flush()
+            header = proc.stdout.readline().split()
+            if header[-1] == "missing":
+                yield path, None, None
+                continue
+            contents = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            if header[1] == "blob":
+                yield path, header[0], contents
+            else:
+                yield path, None, None
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+
+def build_chunk_at(tests_root, rev, paths, url_base, version):
+    """Build the JSON form of a manifest for the files among paths that
+    exist at rev, from the contents git has for them. As with build_chunk,
+    reftests are only resolved once the chunk is merged."""
+    items = defaultdict(dict)
+    path_hashes = {}
+    for rel_path, file_hash, contents in iter_blobs(tests_root, rev, paths):
+        if contents is None:
+            continue
+        source_file = sourcefile.SourceFile(tests_root, rel_path, url_base, contents=contents)
+        item_type, file_items = source_file.manifest_items()
+        key = rel_path.replace(os.path.sep, "/")
+        items[item_type][key] = sorted(item.to_json() for item in file_items)
+        path_hashes[key] = [file_hash, item_type]
+    return {"items": dict(items), "paths": path_hashes, "url_base": url_base, "version": version}
+
+
+def path_items(data, paths):
+    """Return a dict mapping each of paths that is in the JSON form of a
+    manifest, and every reftest file in it, to a tuple of its item type and
+    its items."""
+    rv = {}
+    for item_type, type_paths in data["items"].iteritems():
+        for rel_path, items in type_paths.iteritems():
+            if rel_path in paths or item_type in ("reftest", "reftest_node"):
+                rv[rel_path] = (item_type, items)
+    return rv
+
+
+def diff_revs(tests_root, base, head, head_data):
+    """Compare the manifest items of two revisions.
+
+    Only the paths that differ between the revisions are classified, from
+    the contents git has for them, so neither revision is checked out or
+    has its full manifest built. Every other path is the same in both, so
+    its entry is taken from head_data, and merging the two lets reftests
+    be resolved as they would be in the full manifests. That way a file
+    whose type changes because a changed file added or dropped a reference
+    to it is reported too.
+
+    :param head_data: JSON form of the manifest of the working tree, which
+                      must be checked out at head; files that differ from
+                      head are classified from git as well
+    :returns: Tuple of lists of the added (path, (type, items)), removed
+              (path, (type, items)) and changed (path, (type, items),
+              (type, items)) entries, sorted by path.
+    """
+    url_base = head_data["url_base"]
+    version = head_data["version"]
+    changed, deleted = git_changes(tests_root, base, head)
+    local_changed, local_deleted = git_changes(tests_root, head)
+    paths = sorted(set(changed) | set(deleted) | set(local_changed) | set(local_deleted))
+    keys = {path.replace(os.path.sep, "/") for path in paths}
+
+    shared = {"url_base": url_base,
+              "version": version,
+              "paths": {rel_path: value for rel_path, value in head_data["paths"].iteritems()
+                        if rel_path not in keys},
+              "items": {item_type: {rel_path: items for rel_path, items in type_paths.iteritems()
+                                    if rel_path not in keys}
+                        for item_type, type_paths in head_data["items"].iteritems()}}
+    before = path_items(merge([shared, build_chunk_at(tests_root, base, paths, url_base, version)]),
+                        keys)
+    after = path_items(merge([shared, build_chunk_at(tests_root, head, paths, url_base, version)]),
+                       keys)
+
+    all_paths = sorted(set(before) | set(after))
+    added = [(path, after[path]) for path in all_paths
+             if path in after and path not in before]
+    removed = [(path, before[path]) for path in all_paths
+               if path in before and path not in after]
+    modified = [(path, before[path], after[path]) for path in all_paths
+                if path in before and path in after and before[path] != after[path]]
+    return added, removed, modified
+
+
+def update_from_git(tests_root, manifest_path):
+    """Bring the manifest at manifest_path up to date with the working tree,
+    using the changes since the revision it was last built for, and the
+    paths that were modified in the working tree back then. The manifest
+    file is left untouched if nothing changed.
+
+    :returns: The updated Manifest, False if it was already up to date, or
+              None if the manifest has to be rebuilt.
+    """
+    rev = read_rev(manifest_path)
+    if rev is None or not os.path.exists(manifest_path):
+        return None
+    try:
+        changed, deleted = git_changes(tests_root, rev)
+    except subprocess.CalledProcessError:
+        logger.debug("Revision %s not found" % rev)
+        return None
+    generated = is_generated(tests_root, manifest_path)
+    changed = [path for path in set(changed) | set(read_dirty(manifest_path))
+               if not generated(path)]
+    if not changed and not deleted:
+        rv = False
+    else:
+        rv = update(tests_root, manifest_path, changed, deleted)
+    if rv is not None:
+        record_rev(tests_root, manifest_path)
+    return rv
+
+
+def build_chunk(args):
+    """Build the JSON form of a manifest for a subset of the files."""
+    tests_root, url_base, rel_paths = args
+    chunk_manifest = manifest.Manifest(url_base)
+    chunk_manifest.update(sourcefile.SourceFile(tests_root, rel_path, url_base)
+                          for rel_path in rel_paths)
+    return chunk_manifest.to_json()
+
+
+def chunk_paths(rel_paths, chunk_size):
+    """Split paths into chunks by top-level directory, further splitting
+    directories with more than chunk_size paths so that the work stays
+    balanced."""
+    by_dir = defaultdict(list)
+    for rel_path in sorted(rel_paths):
+        by_dir[rel_path.split(os.path.sep, 1)[0] if os.path.sep in rel_path else ""].append(rel_path)
+    chunks = []
+    for name in sorted(by_dir):
+        paths = by_dir[name]
+        chunks.extend(paths[i:i + chunk_size] for i in xrange(0, len(paths), chunk_size))
+    # Start the largest chunks first
+    chunks.sort(key=lambda x: -len(x))
+    return chunks
+
+
+def merge(chunk_data):
+    """Merge the JSON forms of manifests built for disjoint sets of paths.
+
+    Whether a reftest file is a test in its own right or only a reference
+    depends on every other reftest, so that is decided again across all the
+    chunks, in the same way as Manifest.update does: any node that another
+    node references is a reftest_node, and every other one a reftest."""
+    rv = {"items": defaultdict(dict), "paths": {}, "url_base": "/"}
+    reftest_types = ("reftest", "reftest_node")
+    for data in chunk_data:
+        rv["url_base"] = data["url_base"]
+        rv["version"] = data["version"]
+        rv["paths"].update(data["paths"])
+        for item_type, paths in data["items"].iteritems():
+            rv["items"][item_type].update(paths)
+
+    has_inbound = {ref_url
+                   for item_type in reftest_types
+                   for items in rv["items"].get(item_type, {}).itervalues()
+                   for item in items
+                   for ref_url, _ in item[1]}
+    reftests = defaultdict(list)
+    for item_type in reftest_types:
+        for rel_path, items in rv["items"].pop(item_type, {}).iteritems():
+            for item in items:
+                new_type = "reftest_node" if item[0] in has_inbound else "reftest"
+                reftests[new_type].append((rel_path, item))
+                rv["paths"][rel_path] = [rv["paths"][rel_path][0], new_type]
+    for item_type in reftest_types:
+        by_path = defaultdict(list)
+        for rel_path, item in reftests[item_type]:
+            by_path[rel_path].append(item)
+        rv["items"][item_type] = {rel_path: sorted(items) for rel_path, items in by_path.iteritems()}
+    rv["items"] = dict(rv["items"])
+    return rv
+
+
+def classifier_version():
+    """Return a hash of the manifest classification code, so that cached
+    classifications are discarded when it changes."""
+    digest = hashlib.sha1()
+    code_dir = os.path.dirname(os.path.abspath(sourcefile.__file__))
+    for name in sorted(os.listdir(code_dir)):
+        if name.endswith(".py"):
+            with open(os.path.join(code_dir, name), "rb") as f:
+                digest.update(name + "\0" + f.read())
+    return digest.hexdigest()
+
+
+def blob_hash(path):
+    """Return the git blob hash of the file at path, which is what the
+    manifest records for each path."""
+    with open(path, "rb") as f:
+        contents = f.read()
+    return hashlib.sha1("blob %i\0%s" % (len(contents), contents)).hexdigest()
+
+
+def index_hashes(tests_root):
+    """Return a dict mapping each tracked file that is unmodified in the
+    working tree to its blob hash in git's index."""
+    rv = {}
+    for entry in git(tests_root, "ls-files", "-s", "-z").split("\0")[:-1]:
+        info, rel_path = entry.split("\t", 1)
+        mode, file_hash, _ = info.split()
+        if mode != "160000":
+            rv[os.path.normpath(rel_path)] = file_hash
+    for rel_path in git(tests_root, "diff", "--name-only", "-z").split("\0")[:-1]:
+        rv.pop(os.path.normpath(rel_path), None)
+    return rv
+
+
+class ClassificationCache(object):
+    """Persistent cache of the manifest items of each file.
+
+    Every file is recorded with its size, modification time and git blob
+    hash. A file whose size and mtime are unchanged is reused without being
+    read. If they differ, or the mtime is too close to when the cache was
+    taken to tell whether the file changed afterwards, the hash is checked
+    instead: it comes from git's index for unmodified tracked files, so
+    after a fresh checkout the files don't even need to be read.
+
+    :param path: Path to the JSON cache file
+    :param version: Version of the classification code
+    :param url_base: URL base the items were classified for
+    """
+    def __init__(self, path, version, url_base):
+        self.path = path
+        self.version = version
+        self.url_base = url_base
+        self.manifest_version = None
+        self.snapshot = 0
+        self.files = {}
+
+    @classmethod
+    def load(cls, path, version, url_base):
+        rv = cls(path, version, url_base)
+        try:
+            with open(path, "rb") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return rv
+        if data.get("version") == version and data.get("url_base") == url_base:
+            rv.manifest_version = data["manifest_version"]
+            rv.snapshot = data["snapshot"]
+            rv.files = data["files"]
+        return rv
+
+    def lookup(self, rel_path, size, mtime, get_hash):
+        """Return the cached (hash, item type, items) of rel_path, or None
+        if it has to be classified again.
+
+        :param get_hash: Callable returning the current hash of the file"""
+        entry = self.files.get(rel_path.replace(os.path.sep, "/"))
+        if entry is None:
+            return None
+        cached_size, cached_mtime, file_hash, item_type, items = entry
+        if (size != cached_size or mtime != cached_mtime or
+            int(mtime) >= int(self.snapshot)):
+            if get_hash() != file_hash:
+                return None
+        return file_hash, item_type, items
+
+    def store(self, data, stats, snapshot):
+        """Replace the cache with the classifications in the JSON form of a
+        manifest.
+
+        :param stats: Dict mapping each path to its (size, mtime) as they
+                      were before it was classified
+        :param snapshot: Time at which the stats were taken"""
+        files = {}
+        for item_type, paths in data["items"].iteritems():
+            for rel_path, items in paths.iteritems():
+                size, mtime = stats[os.path.normpath(rel_path)]
+                files[rel_path] = [size, mtime, data["paths"][rel_path][0], item_type, items]
+        self.files = files
+        self.snapshot = snapshot
+        self.manifest_version = data["version"]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump({"version": self.version,
+                       "url_base": self.url_base,
+                       "manifest_version": self.manifest_version,
+                       "snapshot": snapshot,
+                       "files": files}, f)
+        os.rename(tmp_path, self.path)
+
+
+def build(tests_root, manifest_path, processes=None, chunk_size=500, use_cache=True):
+    """Build the manifest for every file git knows about from scratch,
+    classifying the files on a pool of processes, and write it to
+    manifest_path.
+
+    Unless use_cache is False, files whose classification is in the
+    ClassificationCache next to the manifest aren't classified again.
+
+    :returns: The JSON form of the manifest."""
+    processes = processes or multiprocessing.cpu_count()
+    tracked = git(tests_root, "ls-files", "-z").split("\0")[:-1]
+    untracked = git(tests_root, "ls-files", "--others", "--exclude-standard", "-z").split("\0")[:-1]
+    generated = is_generated(tests_root, manifest_path)
+    rel_paths = [os.path.normpath(path) for path in tracked + untracked]
+    rel_paths = [path for path in rel_paths
+                 if not generated(path) and os.path.isfile(os.path.join(tests_root, path))]
+
+    url_base = "/"
+    snapshot = time.time()
+    cache = ClassificationCache.load(cache_path(manifest_path), classifier_version(), url_base)
+    if not use_cache:
+        cache.files = {}
+    hashes = index_hashes(tests_root) if cache.files else {}
+    cached = {"items": defaultdict(dict),
+              "paths": {},
+              "url_base": url_base,
+              "version": cache.manifest_version}
+    stats = {}
+    classify = []
+    for rel_path in rel_paths:
+        full_path = os.path.join(tests_root, rel_path)
+        st = os.stat(full_path)
+        stats[rel_path] = (st.st_size, st.st_mtime)
+        hit = cache.lookup(rel_path, st.st_size, st.st_mtime,
+                           lambda: hashes.get(rel_path) or blob_hash(full_path))
+        if hit is None:
+            classify.append(rel_path)
+        else:
+            file_hash, item_type, items = hit
+            key = rel_path.replace(os.path.sep, "/")
+            cached["items"][item_type][key] = items
+            cached["paths"][key] = [file_hash, item_type]
+
+    jobs = [(tests_root, url_base, chunk) for chunk in chunk_paths(classify, chunk_size)]
+    logger.debug("Classifying %i of %i files in %i chunks on %i processes" %
+                 (len(classify), len(rel_paths), len(jobs), processes))
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunk_data = pool.map(build_chunk, jobs, chunksize=1)
+        finally:
+            pool.terminate()
+    else:
+        chunk_data = [build_chunk(job) for job in jobs]
+    if cached["paths"]:
+        chunk_data.append(cached)
+
+    data = merge(chunk_data)
+    write_json(data, manifest_path)
+    if use_cache:
+        cache.store(data, stats, snapshot)
+    return data
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Build MANIFEST.json on a pool of processes.")
+    parser.add_argument("-p", "--path", action="store",
+                        help="Path to the manifest file")
+    parser.add_argument("--tests-root", action="store",
+                        default=os.path.abspath(os.path.dirname(__file__)),
+                        help="Root of the tests")
+    parser.add_argument("--processes", action="store", type=int,
+                        help="Number of processes to use (defaults to the number of CPUs)")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache",
+                        help="Classify every file again rather than using the cached results")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+    args = get_parser().parse_args()
+    manifest_path = args.path or os.path.join(args.tests_root, "MANIFEST.json")
+    build(args.tests_root, manifest_path, args.processes, use_cache=args.use_cache)
+    record_rev(args.tests_root, manifest_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
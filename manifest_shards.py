@@ -0,0 +1,386 @@
+"""Sharded, memory-mapped binary form of MANIFEST.json.
+
+The manifest is split by top-level directory into one shard file each,
+alongside an index.json listing the shards, the number of paths of each
+type they hold, and the size and modification time of the MANIFEST.json
+they were written from. A shard is only opened, and then memory-mapped,
+the first time a path in its directory is looked up, so questions about
+a few directories never read the rest of the tree.
+
+The shards double as persistent indexes: looking up the type of a path
+and finding the paths under a directory prefix are binary searches over
+the sorted paths, and the paths of each type are listed in a
+precomputed table, so none of these queries build sets of paths. The
+paths of a shard are stored as one block, which is split into a list the
+first time the shard is used, so that the searches run in C through
+bisect rather than decoding a record per step.
+
+Shard layout (little-endian):
+
+    magic     8 bytes, "WPTSHRD3"
+    count     uint32, the number of entries
+    types     uint8 number of types, then each type name as a uint8
+              length followed by the name
+    records   count fixed-size records, in path order, of
+              uint8 type index, uint32 items offset, uint32 items length
+    by type   for each type in order, a uint32 count followed by the
+              indices of the records of that type, in path order
+    paths     uint32 length, then the sorted "/"-separated paths of every
+              entry, UTF-8 encoded and joined by newlines
+    data      the JSON-encoded manifest items of every entry; record
+              offsets are relative to its start
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_left
+from collections import defaultdict
+
+magic = "WPTSHRD3"
+record = struct.Struct("<BII")
+count_struct = struct.Struct("<I")
+index_name = "index.json"
+root_shard = ""
+
+
+def shard_dir(manifest_path):
+    """Return the directory holding the shards for manifest_path."""
+    return os.path.splitext(manifest_path)[0] + ".shards"
+
+
+def top_dir(rel_path):
+    """Return the name of the shard holding a "/"-separated path."""
+    if "/" not in rel_path:
+        return root_shard
+    return rel_path.split("/", 1)[0]
+
+
+def shard_file(name):
+    return "%s.shard" % (name or "_root")
+
+
+def os_path(rel_path):
+    """Convert a "/"-separated path to the OS form."""
+    return rel_path.replace("/", os.path.sep) if os.path.sep != "/" else rel_path
+
+
+def source_stamp(manifest_path):
+    st = os.stat(manifest_path)
+    return [st.st_size, st.st_mtime]
+
+
+def write_shard(path, entries):
+    """Write a shard holding entries, a list of (path, item type, JSON
+    items) tuples sorted by path."""
+    types = sorted({item_type for _, item_type, _ in entries})
+    type_ids = {item_type: i for i, item_type in enumerate(types)}
+    records = []
+    by_type = [[] for _ in types]
+    paths = "\n".join(rel_path for rel_path, _, _ in entries).encode("utf8")
+    data = []
+    offset = 0
+    for i, (_, item_type, items) in enumerate(entries):
+        by_type[type_ids[item_type]].append(i)
+        records.append(record.pack(type_ids[item_type], offset, len(items)))
+        data.append(items)
+        offset += len(items)
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(count_struct.pack(len(entries)))
+        f.write(struct.pack("<B", len(types)))
+        for item_type in types:
+            f.write(struct.pack("<B", len(item_type)) + item_type)
+        f.write("".join(records))
+        for indices in by_type:
+            f.write(count_struct.pack(len(indices)))
+            f.write(struct.pack("<%iI" % len(indices), *indices))
+        f.write(count_struct.pack(len(paths)))
+        f.write(paths)
+        f.write("".join(data))
+
+
+def write(manifest_path, dest=None, data=None):
+    """Write the shards for the manifest at manifest_path, replacing any
+    existing shards.
+
+    :param data: The JSON form of the manifest, if it is already in memory;
+                 otherwise it is read from manifest_path
+    """
+    if dest is None:
+        dest = shard_dir(manifest_path)
+    stamp = source_stamp(manifest_path)
+    if data is None:
+        with open(manifest_path, "rb") as f:
+            data = json.load(f)
+
+    by_dir = defaultdict(list)
+    for item_type, paths in data["items"].iteritems():
+        item_type = item_type.encode("ascii")
+        for rel_path, items in paths.iteritems():
+            by_dir[top_dir(rel_path)].append(
+                (rel_path, item_type, json.dumps(items, separators=(",", ":"))))
+
+    parent = os.path.dirname(os.path.abspath(dest))
+    tmp_dest = tempfile.mkdtemp(dir=parent, prefix=".shards.")
+    try:
+        shards = {}
+        for name, entries in by_dir.iteritems():
+            entries.sort()
+            write_shard(os.path.join(tmp_dest, shard_file(name)), entries)
+            types = defaultdict(int)
+            for _, item_type, _ in entries:
+                types[item_type] += 1
+            shards[name] = {"file": shard_file(name), "types": types}
+        with open(os.path.join(tmp_dest, index_name), "wb") as f:
+            json.dump({"version": magic, "source": stamp, "shards": shards}, f,
+                      sort_keys=True)
+
+        old_dest = None
+        if os.path.exists(dest):
+            old_dest = tempfile.mkdtemp(dir=parent, prefix=".shards.")
+            os.rename(dest, os.path.join(old_dest, "old"))
+        os.rename(tmp_dest, dest)
+        if old_dest is not None:
+            shutil.rmtree(old_dest)
+    except:
+        shutil.rmtree(tmp_dest, ignore_errors=True)
+        raise
+
+
+class Shard(object):
+    """Read access to a single memory-mapped shard file."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(magic)] != magic:
+            raise ValueError("%s is not a manifest shard" % path)
+        offset = len(magic)
+        self.count, = count_struct.unpack_from(self.data, offset)
+        offset += count_struct.size
+        n_types = ord(self.data[offset])
+        offset += 1
+        self.types = []
+        for _ in xrange(n_types):
+            length = ord(self.data[offset])
+            self.types.append(self.data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        self.records_start = offset
+        offset += self.count * record.size
+        # Offset and length of the table of record indices of each type
+        self.by_type = {}
+        for item_type in self.types:
+            length, = count_struct.unpack_from(self.data, offset)
+            self.by_type[item_type] = (offset + count_struct.size, length)
+            offset += count_struct.size * (length + 1)
+        paths_length, = count_struct.unpack_from(self.data, offset)
+        self.paths_start = offset + count_struct.size
+        self.data_start = self.paths_start + paths_length
+        self._paths = None
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def paths(self):
+        """The sorted list of the paths in the shard."""
+        if self._paths is None:
+            self._paths = (self.data[self.paths_start:self.data_start].decode("utf8").split("\n")
+                           if self.count else [])
+        return self._paths
+
+    def _record(self, i):
+        return record.unpack_from(self.data, self.records_start + i * record.size)
+
+    def find(self, rel_path):
+        """Return the index of the entry for a "/"-separated path, or None."""
+        if isinstance(rel_path, str):
+            rel_path = rel_path.decode("utf8")
+        paths = self.paths
+        i = bisect_left(paths, rel_path)
+        if i < len(paths) and paths[i] == rel_path:
+            return i
+        return None
+
+    def count_of_type(self, item_type):
+        return self.by_type.get(item_type, (0, 0))[1]
+
+    def iter_type(self, item_type):
+        """Iterate over the paths of the given type, in path order."""
+        if item_type not in self.by_type:
+            return
+        start, length = self.by_type[item_type]
+        paths = self.paths
+        for i in struct.unpack_from("<%iI" % length, self.data, start):
+            yield paths[i]
+
+    def iter_prefix(self, prefix):
+        """Iterate over the (path, item type) of every entry whose path
+        starts with the "/"-separated prefix, in path order."""
+        if isinstance(prefix, str):
+            prefix = prefix.decode("utf8")
+        paths = self.paths
+        for i in xrange(bisect_left(paths, prefix), self.count):
+            rel_path = paths[i]
+            if not rel_path.startswith(prefix):
+                break
+            yield rel_path, self.types[self._record(i)[0]]
+
+    def type_of(self, rel_path):
+        i = self.find(rel_path)
+        return self.types[self._record(i)[0]] if i is not None else None
+
+    def items(self, rel_path):
+        """Return the JSON form of the manifest items for rel_path, or None."""
+        i = self.find(rel_path)
+        if i is None:
+            return None
+        _, offset, length = self._record(i)
+        start = self.data_start + offset
+        return json.loads(self.data[start:start + length])
+
+    def __iter__(self):
+        """Iterate over the (path, item type) of every entry, in path order."""
+        for i, rel_path in enumerate(self.paths):
+            yield rel_path, self.types[self._record(i)[0]]
+
+
+class ShardedManifest(object):
+    """Lazily loaded view of the manifest held in a shard directory.
+
+    Paths may be given with either "/" or the OS path separator, and are
+    returned in the OS form, like the paths of the JSON manifest.
+
+    :param path: Directory holding the shards
+    :param index: The parsed index.json of the directory
+    """
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index["shards"]
+        self._shards = {}
+        self._types = {}
+
+    @classmethod
+    def load(cls, manifest_path, path=None):
+        """Return the ShardedManifest for manifest_path, or None if there are
+        no shards, they are in an older format or they were written from a
+        different version of the manifest."""
+        if path is None:
+            path = shard_dir(manifest_path)
+        try:
+            with open(os.path.join(path, index_name), "rb") as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if index.get("version") != magic:
+            return None
+        try:
+            if index["source"] != source_stamp(manifest_path):
+                return None
+        except OSError:
+            return None
+        return cls(path, index)
+
+    def shard(self, name):
+        """Return the Shard for a top-level directory, or None."""
+        if name not in self._shards:
+            info = self.index.get(name)
+            self._shards[name] = (Shard(os.path.join(self.path, info["file"]))
+                                  if info is not None else None)
+        return self._shards[name]
+
+    def close(self):
+        for shard in self._shards.itervalues():
+            if shard is not None:
+                shard.close()
+        self._shards = {}
+
+    def type_of(self, rel_path):
+        """Return the manifest item type of rel_path, or None. Results are
+        memoized, so repeated membership tests are dictionary lookups."""
+        rv = self._types.get(rel_path, False)
+        if rv is False:
+            key = rel_path.replace(os.path.sep, "/")
+            shard = self.shard(top_dir(key))
+            rv = self._types[rel_path] = shard.type_of(key) if shard is not None else None
+        return rv
+
+    def items(self, rel_path):
+        rel_path = rel_path.replace(os.path.sep, "/")
+        shard = self.shard(top_dir(rel_path))
+        return shard.items(rel_path) if shard is not None else None
+
+    def count(self, *types):
+        """Return the number of paths of the given types, from the index."""
+        return sum(self.index[name]["types"].get(item_type, 0)
+                   for name in self.index for item_type in types)
+
+    def iterpaths(self, *types):
+        """Iterate over the (item type, path) of every entry of the given
+        types, only opening the shards that hold any."""
+        for name in sorted(self.index):
+            shard_types = self.index[name]["types"]
+            for item_type in types:
+                if shard_types.get(item_type):
+                    for rel_path in self.shard(name).iter_type(item_type):
+                        yield item_type, os_path(rel_path)
+
+    def iterprefix(self, prefix, *types):
+        """Iterate over the (item type, path) of every entry under a
+        directory prefix, optionally restricted to the given types.
+
+        :param prefix: Path prefix, e.g. "html/semantics/"; a prefix
+                       without a separator matches the start of the
+                       top-level names
+        """
+        prefix = prefix.replace(os.path.sep, "/")
+        if "/" in prefix:
+            names = [top_dir(prefix)]
+        else:
+            names = sorted(name for name in self.index
+                           if name.startswith(prefix) or name == root_shard)
+        for name in names:
+            if name not in self.index:
+                continue
+            shard_prefix = prefix if name == root_shard or "/" in prefix else name
+            for rel_path, item_type in self.shard(name).iter_prefix(shard_prefix):
+                if not types or item_type in types:
+                    yield item_type, os_path(rel_path)
+
+
+class PathSet(object):
+    """Set-like view of the paths of a ShardedManifest with given item types.
+    Membership tests are memoized.
+
+    :param skip_dirs: Top-level directories whose paths are left out
+    """
+    def __init__(self, sharded, types, skip_dirs=()):
+        self.sharded = sharded
+        self.types = set(types)
+        self.skip_dirs = set(skip_dirs)
+        self._contains = {}
+
+    def __contains__(self, rel_path):
+        rv = self._contains.get(rel_path)
+        if rv is None:
+            rv = self._contains[rel_path] = (
+                rel_path.split(os.path.sep, 1)[0] not in self.skip_dirs and
+                self.sharded.type_of(rel_path) in self.types)
+        return rv
+
+    def __iter__(self):
+        for _, rel_path in self.sharded.iterpaths(*self.types):
+            if rel_path.split(os.path.sep, 1)[0] not in self.skip_dirs:
+                yield rel_path
+
+    def __len__(self):
+        return (self.sharded.count(*self.types) -
+                sum(self.sharded.index[name]["types"].get(item_type, 0)
+                    for name in self.skip_dirs if name in self.sharded.index
+                    for item_type in self.types))
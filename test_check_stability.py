@@ -0,0 +1,123 @@
+import sys
+import threading
+import time
+
+import pytest
+
+import check_stability
+
+
+def run_in_thread(func, timeout=10):
+    """Call func on a thread, failing instead of hanging if it doesn't
+    return within timeout seconds, and return its result or exception."""
+    rv = {}
+
+    def target():
+        try:
+            rv["result"] = func()
+        except BaseException:
+            rv["error"] = sys.exc_info()[1]
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "Timed out"
+    return rv
+
+
+def test_ref_scanner(tmpdir):
+    scanner = check_stability.RefScanner([".js", ".css"])
+    path = tmpdir.join("test.html")
+    path.write("<script src=helper.js></script><link href='/common/style.css'>"
+               "<script src=other.jsx></script>")
+    # Rooted references also match any path they are a suffix of
+    assert scanner.scan(str(path), "dir/test.html") == {"dir/helper.js",
+                                                      "common/style.css",
+                                                      "style.css"}
+
+
+@pytest.mark.parametrize("encoding,bom", [("utf-16-le", "\xff\xfe"),
+                                          ("utf-16-be", "\xfe\xff")])
+def test_ref_scanner_utf16(tmpdir, encoding, bom):
+    scanner = check_stability.RefScanner([".js"])
+    path = tmpdir.join("test.html")
+    path.write(bom + u"<script src='../helper.js'></script>".encode(encoding), "wb")
+    assert scanner.scan(str(path), "dir/test.html") == {"helper.js"}
+
+
+def test_ref_scanner_long_run(tmpdir):
+    # A long run of path characters, like base64 data, is scanned in linear
+    # time; a quadratic scan takes seconds at this size
+    scanner = check_stability.RefScanner([".js", ".png"])
+    path = tmpdir.join("test.html")
+    path.write("<img src='data:image/png;base64,%s'><script src=a.js></script>" %
+               ("Ab+/" * 32 * 1024))
+    start = time.time()
+    assert scanner.scan(str(path), "test.html") == {"a.js"}
+    assert time.time() - start < 1
+
+
+def test_run_steps_order():
+    order = []
+    durations = check_stability.run_steps({
+        "a": (lambda: order.append("a"), ()),
+        "b": (lambda: order.append("b"), ("a",)),
+        "c": (lambda: order.append("c"), ("b",))})
+    assert order == ["a", "b", "c"]
+    assert sorted(durations) == ["a", "b", "c"]
+
+
+def test_run_steps_exception():
+    started = []
+
+    def fail():
+        raise IOError("download failed")
+
+    rv = run_in_thread(lambda: check_stability.run_steps({
+        "fail": (fail, ()),
+        "after": (lambda: started.append("after"), ("fail",))}))
+    assert isinstance(rv.get("error"), IOError)
+    assert started == []
+
+
+def test_run_steps_system_exit():
+    started = []
+
+    def exit():
+        sys.exit(1)
+
+    rv = run_in_thread(lambda: check_stability.run_steps({
+        "exit": (exit, ()),
+        "other": (lambda: None, ()),
+        "after": (lambda: started.append("after"), ("exit",))}))
+    assert isinstance(rv.get("error"), SystemExit)
+    assert started == []
+
+
+def test_run_steps_unsatisfiable():
+    with pytest.raises(ValueError):
+        check_stability.run_steps({"a": (lambda: None, ("missing",))})
+
+
+def test_read_ahead_close(monkeypatch):
+    class Endless(object):
+        def read(self, size):
+            return "x" * size
+
+    monkeypatch.setattr(check_stability.ReadAhead, "put_timeout", 0.01)
+    with check_stability.ReadAhead(Endless(), chunk_size=4, max_chunks=2) as read_ahead:
+        assert read_ahead.read(6) == "x" * 6
+    # The thread is blocked on the full buffer until the reader is closed
+    read_ahead.thread.join(5)
+    assert not read_ahead.thread.is_alive()
+
+
+@pytest.mark.parametrize("args", [["--adaptive", "--confirm"],
+                                  ["--adaptive", "--shard-tests"],
+                                  ["--confirm", "--shard-tests"]])
+def test_parser_exclusive_modes(args):
+    parser = check_stability.get_parser()
+    assert parser.parse_args(["firefox", args[0]])
+    with pytest.raises(SystemExit):
+        parser.parse_args(["firefox"] + args)
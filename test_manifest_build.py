@@ -0,0 +1,143 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+manifest = pytest.importorskip("tools.manifest.manifest")
+sourcefile = pytest.importorskip("tools.manifest.sourcefile")
+
+import manifest_build
+
+testharness = """<!doctype html>
+<script src="/resources/testharness.js"></script>
+<script src="/resources/testharnessreport.js"></script>
+"""
+
+reftest = """<!doctype html>
+<link rel="match" href="%s">
+<p>Test</p>
+"""
+
+# r1.html references r2.html, which references r3.html, so r2.html is both a
+# reference and a test
+files = {
+    "a.html": testharness,
+    "dom/b.html": testharness,
+    "css/r1.html": reftest % "r2.html",
+    "css/r2.html": reftest % "r3.html",
+    "css/r3.html": "<!doctype html>\n<p>Reference</p>\n",
+    "css/support/helper.js": "var x = 1;\n",
+}
+
+
+def git(tests_root, *args):
+    return subprocess.check_output(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] +
+                                   list(args), cwd=tests_root)
+
+
+def write_file(tests_root, rel_path, contents):
+    path = os.path.join(tests_root, *rel_path.split("/"))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+def make_tree(tmpdir):
+    tests_root = str(tmpdir.mkdir("wpt"))
+    for rel_path, contents in files.iteritems():
+        write_file(tests_root, rel_path, contents)
+    git(tests_root, "init", "-q")
+    git(tests_root, "add", "-A")
+    git(tests_root, "commit", "-q", "-m", "Initial")
+    return tests_root, os.path.join(tests_root, "MANIFEST.json")
+
+
+def serial_json(tests_root):
+    """Return the JSON form of the manifest built by tools.manifest alone,
+    one file after another."""
+    rel_paths = []
+    for dir_path, dir_names, file_names in os.walk(tests_root):
+        if ".git" in dir_names:
+            dir_names.remove(".git")
+        rel_paths.extend(os.path.relpath(os.path.join(dir_path, name), tests_root)
+                         for name in file_names)
+    generated = manifest_build.is_generated(tests_root, os.path.join(tests_root, "MANIFEST.json"))
+    wpt_manifest = manifest.Manifest("/")
+    wpt_manifest.update(sourcefile.SourceFile(tests_root, rel_path, "/")
+                        for rel_path in sorted(rel_paths) if not generated(rel_path))
+    return json.loads(json.dumps(wpt_manifest.to_json()))
+
+
+def read_json(path):
+    with open(path, "rb") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_build(tmpdir, processes):
+    tests_root, manifest_path = make_tree(tmpdir)
+    data = manifest_build.build(tests_root, manifest_path, processes=processes, chunk_size=1,
+                                use_cache=False)
+    expected = serial_json(tests_root)
+    assert read_json(manifest_path) == expected
+    assert json.loads(json.dumps(data)) == expected
+    assert set(expected["items"]["reftest"]) == {"css/r1.html"}
+    assert set(expected["items"]["reftest_node"]) == {"css/r2.html"}
+
+
+def test_update(tmpdir):
+    tests_root, manifest_path = make_tree(tmpdir)
+    manifest_build.build(tests_root, manifest_path, processes=1, use_cache=False)
+    # r3.html becomes a test of its own, that references a.html, and the
+    # chain loses r1.html, so r2.html is no longer a reference
+    write_file(tests_root, "css/r3.html", reftest % "/a.html")
+    os.unlink(os.path.join(tests_root, "css", "r1.html"))
+    write_file(tests_root, "dom/c.html", testharness)
+    manifest_build.update(tests_root, manifest_path,
+                          [os.path.join("css", "r3.html"), os.path.join("dom", "c.html")],
+                          [os.path.join("css", "r1.html")])
+    assert read_json(manifest_path) == serial_json(tests_root)
+
+
+def test_index_hashes(tmpdir):
+    tests_root, _ = make_tree(tmpdir)
+    write_file(tests_root, "a.html", testharness + "<p>Modified</p>\n")
+    write_file(tests_root, "untracked.html", testharness)
+    hashes = manifest_build.index_hashes(tests_root)
+    expected = {os.path.normpath(rel_path) for rel_path in files if rel_path != "a.html"}
+    assert set(hashes) == expected
+    for rel_path in expected:
+        assert hashes[rel_path] == manifest_build.blob_hash(os.path.join(tests_root, rel_path))
+
+
+def test_build_cached(tmpdir):
+    tests_root, manifest_path = make_tree(tmpdir)
+    manifest_build.build(tests_root, manifest_path, processes=2, chunk_size=1)
+    assert os.path.exists(manifest_build.cache_path(manifest_path))
+    write_file(tests_root, "css/r3.html", reftest % "/a.html")
+    os.unlink(os.path.join(tests_root, "css", "r1.html"))
+    write_file(tests_root, "dom/c.html", testharness)
+    manifest_build.build(tests_root, manifest_path, processes=2, chunk_size=1)
+    assert read_json(manifest_path) == serial_json(tests_root)
+
+
+def test_cache_version(tmpdir, monkeypatch):
+    tests_root, manifest_path = make_tree(tmpdir)
+    manifest_build.build(tests_root, manifest_path, processes=2, chunk_size=1)
+
+    # Give the cached entry different items, to tell whether it is used
+    path = manifest_build.cache_path(manifest_path)
+    cache_data = read_json(path)
+    tampered = [["/tampered.html", {}]]
+    cache_data["files"]["dom/b.html"][4] = tampered
+    with open(path, "wb") as f:
+        json.dump(cache_data, f)
+    data = manifest_build.build(tests_root, manifest_path, processes=2, chunk_size=1)
+    assert data["items"]["testharness"]["dom/b.html"] == tampered
+
+    monkeypatch.setattr(manifest_build, "classifier_version", lambda: "changed")
+    assert manifest_build.ClassificationCache.load(path, "changed", "/").files == {}
+    manifest_build.build(tests_root, manifest_path, processes=2, chunk_size=1)
+    assert read_json(manifest_path) == serial_json(tests_root)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import manifest_shards
+
+
+def make_manifest(tmpdir):
+    items = {
+        "testharness": {
+            "dom/a.html": [["/dom/a.html", {}]],
+            "dom/nodes/b.html": [["/dom/nodes/b.html", {"timeout": "long"}]],
+            u"dom/é.html": [[u"/dom/é.html", {}]],
+            "top.html": [["/top.html", {}]],
+        },
+        "reftest": {
+            "css/c.html": [["/css/c.html", [["/css/c-ref.html", "=="]], {}]],
+        },
+        "support": {
+            "dom/helper.js": [["dom/helper.js", {}]],
+            "css/c-ref.html": [["css/c-ref.html", {}]],
+            "dom-extra/d.js": [["dom-extra/d.js", {}]],
+        },
+    }
+    path = str(tmpdir.join("MANIFEST.json"))
+    with open(path, "wb") as f:
+        json.dump({"items": items, "paths": {}, "url_base": "/", "version": 4}, f)
+    manifest_shards.write(path)
+    return path, items
+
+
+def test_lookups(tmpdir):
+    path, items = make_manifest(tmpdir)
+    sharded = manifest_shards.ShardedManifest.load(path)
+    for item_type, paths in items.iteritems():
+        for rel_path, path_items in paths.iteritems():
+            rel_path = rel_path.replace("/", os.path.sep)
+            assert sharded.type_of(rel_path) == item_type
+            assert sharded.items(rel_path) == path_items
+    assert sharded.type_of(os.path.join("dom", "missing.html")) is None
+    assert sharded.type_of(os.path.join("missing", "a.html")) is None
+    assert sharded.items(os.path.join("dom", "missing.html")) is None
+    sharded.close()
+
+
+def test_iteration(tmpdir):
+    path, items = make_manifest(tmpdir)
+    sharded = manifest_shards.ShardedManifest.load(path)
+    assert sharded.count("testharness", "reftest") == 5
+    assert (sorted(sharded.iterpaths("testharness")) ==
+            sorted(("testharness", rel_path.replace("/", os.path.sep))
+                   for rel_path in items["testharness"]))
+    assert (list(sharded.iterprefix("dom/")) ==
+            [("testharness", os.path.join("dom", "a.html")),
+             ("support", os.path.join("dom", "helper.js")),
+             ("testharness", os.path.join("dom", "nodes", "b.html")),
+             ("testharness", os.path.join("dom", u"é.html"))])
+    assert (list(sharded.iterprefix("dom/nodes/", "testharness")) ==
+            [("testharness", os.path.join("dom", "nodes", "b.html"))])
+    assert (sorted(sharded.iterprefix("dom", "support")) ==
+            sorted([("support", os.path.join("dom", "helper.js")),
+                    ("support", os.path.join("dom-extra", "d.js"))]))
+    sharded.close()
+
+
+def test_path_set(tmpdir):
+    path, _ = make_manifest(tmpdir)
+    sharded = manifest_shards.ShardedManifest.load(path)
+    tests = manifest_shards.PathSet(sharded, ["testharness", "reftest"], skip_dirs=["css"])
+    assert os.path.join("dom", "a.html") in tests
+    assert os.path.join("dom", "a.html") in tests
+    assert os.path.join("css", "c.html") not in tests
+    assert os.path.join("dom", "helper.js") not in tests
+    assert len(tests) == 4
+    assert sorted(tests) == sorted([os.path.join("dom", "a.html"),
+                                    os.path.join("dom", "nodes", "b.html"),
+                                    os.path.join("dom", u"é.html"),
+                                    "top.html"])
+    sharded.close()
+
+
+def test_stale(tmpdir):
+    path, _ = make_manifest(tmpdir)
+    with open(path, "ab") as f:
+        f.write("\n")
+    assert manifest_shards.ShardedManifest.load(path) is None